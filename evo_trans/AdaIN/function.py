@@ -13,11 +13,60 @@ def calc_mean_std(feat, eps=1e-5, mask = None):
     else:
         num_point = torch.sum(mask)
         feat_mean = (feat.view(N, C, -1).sum(dim=2) / num_point).view(N, C, 1, 1)
-        feat_var  = ((feat.view(N, C, -1) - feat_mean.view(N, C, 1).repeat(1, 1, size[2] * size[3])) ** 2).sum(dim=2)/(num_point - 1) + eps
+        feat_var  = ((feat.view(N, C, -1) - feat_mean.view(N, C, 1)) ** 2).sum(dim=2)/(num_point - 1) + eps
         feat_std = feat_var.sqrt().view(N, C, 1, 1)
     return feat_mean, feat_std
 
 
+def calc_mean_std_parts(feat, masks, eps=1e-5):
+    # Moments of every masked part in one pass.
+    # feat: N x C x H x W, masks: K x H x W binary part masks.
+    # Returns mean, std of N x K x C, equal to calc_mean_std(feat * m, mask = m) for each part m
+    # (the masked-out zeros count towards the variance there as well).
+    N, C, H, W = feat.size()
+    K = masks.size(0)
+    feat = feat.view(N, C, H * W)
+    masks = masks.view(K, H * W).t()
+    num_point = masks.sum(dim=0)
+    # shift by the channel mean so the second moment does not lose precision
+    shift = feat.mean(dim=2, keepdim=True)
+    feat = feat - shift
+    part_mean = torch.matmul(feat, masks) / num_point
+    part_sq = torch.matmul(feat ** 2, masks)
+    feat_mean = part_mean + shift
+    feat_var = (part_sq - num_point * part_mean ** 2 + (H * W - num_point) * feat_mean ** 2) / (num_point - 1) + eps
+    return feat_mean.transpose(1, 2), feat_var.sqrt().transpose(1, 2)
+
+
+def adaptive_instance_normalization_parts(content_feat, style_feat, masks, switch=None,
+                                          content_stats=None, style_stats=None):
+    # Masked AdaIN for all parts and samples at once.
+    # masks: K x H x W, switch: N x K (1 gives the part the style features with the
+    # content statistics, 0 the content features with the style statistics).
+    # Returns the sum over parts, i.e. sum_k m_k * adain_k.
+    assert (content_feat.size() == style_feat.size())
+    N, C, H, W = content_feat.size()
+    K = masks.size(0)
+    content_mean, content_std = content_stats if content_stats is not None else calc_mean_std_parts(content_feat, masks)
+    style_mean, style_std = style_stats if style_stats is not None else calc_mean_std_parts(style_feat, masks)
+    if switch is None:
+        swap = torch.zeros(N, K, 1, dtype=torch.bool, device=content_feat.device)
+    else:
+        swap = (torch.as_tensor(switch).to(content_feat.device) == 1).view(N, K, 1)
+    src_mean = torch.where(swap, style_mean, content_mean)
+    src_std = torch.where(swap, style_std, content_std)
+    dst_mean = torch.where(swap, content_mean, style_mean)
+    dst_std = torch.where(swap, content_std, style_std)
+    # per part: (f - src_mean) / src_std * dst_std + dst_mean = scale * f + bias
+    scale = dst_std / src_std
+    bias = dst_mean - src_mean * scale
+    masks = masks.view(K, H * W)
+    style_scale = torch.matmul((scale * swap).transpose(1, 2), masks).view(N, C, H, W)
+    content_scale = torch.matmul((scale * ~swap).transpose(1, 2), masks).view(N, C, H, W)
+    bias = torch.matmul(bias.transpose(1, 2), masks).view(N, C, H, W)
+    return content_feat * content_scale + style_feat * style_scale + bias
+
+
 def mean_variance_norm_m(feat, m = None):
     size = feat.size()
     mean, std = calc_mean_std_m(feat, m)
@@ -1,4 +1,7 @@
-import argparse
+import copy
+import itertools
+import threading
+import os.path as osp
 
 import torch
 import torch.nn as nn
@@ -8,7 +11,9 @@ from torchvision import transforms
 from torchvision.utils import save_image
 
 from ..AdaIN import net
-from ..AdaIN.function import adaptive_instance_normalization, coral
+from ..AdaIN.function import adaptive_instance_normalization, adaptive_instance_normalization_parts, \
+    calc_mean_std_parts, coral
+from ..utils import bundle
 
 
 def test_transform(size, crop):
@@ -22,54 +27,51 @@ def test_transform(size, crop):
     return transform
 
 
+_part_masks = {}
+
+
+def load_part_masks(template_path, size=(64, 128), device='cpu'):
+    """
+    Returns the 5 x H x W one-hot part masks (background, head, neck, back, belly)
+    of a semantic template at the relu4_1 feature resolution.
+    Masks are built once per (template path, size, device) and cached.
+    """
+    device = torch.device(device)
+    key = (osp.abspath(template_path), tuple(size), str(device))
+    if key not in _part_masks:
+        template = np.array(Image.open(template_path))
+        _part_masks[key] = part_masks_from_template(template, size).to(device)
+    return _part_masks[key]
+
+
+def part_masks_from_template(template, size=(64, 128)):
+    """
+    Builds the 5 x H x W one-hot part masks from an H x W semantic template array.
+    """
+    template = torch.as_tensor(template)
+    template = transforms.Resize(list(size))(template[None])[0]
+    return torch.stack([template == i for i in range(5)], dim=0).float()
+
+
 def style_transfer(vgg, decoder, content, style, alpha=1.0,
                    interpolation_weights=None, mask = None, switch_sig=None):
     assert (0.0 <= alpha <= 1.0)
     content_f = vgg(content)
     style_f = vgg(style)
 
-    ##mask###
     if mask is not None:
-        resize = transforms.Resize([64, 128])
-        mask = resize(mask)
-        mask = np.array(mask)
-        mask_res = []
-        for i in range(5):
-            mask_part = mask.copy()
-            mask_part[(mask_part == i)] = 255
-            mask_part[(mask_part == 255) == False] = 0
-                # mask_part = np.resize(mask_part.copy(), (32, 64))
-            # print(mask_part.shape, np.sum(mask_part))
-            # mask_part_2 = np.concatenate([mask_part, mask_part], axis=0)
-            # print(mask_part_2.shape)
-            mask_part = np.round(mask_part / 255.0)
-            # print("mask ", mask_part.shape, np.sum(mask_part))
-            mask_part = torch.from_numpy(mask_part).float().cuda()
-            mask_res.append(mask_part)
-        ###
+        mask_res = mask.to(content_f.device)
 
     if interpolation_weights:
         _, C, H, W = content_f.size()
-        feat = torch.FloatTensor(1, C, H, W).zero_().to(device)
+        feat = torch.FloatTensor(1, C, H, W).zero_().to(content_f.device)
         base_feat = adaptive_instance_normalization(content_f, style_f)
         for i, w in enumerate(interpolation_weights):
             feat = feat + w * base_feat[i:i + 1]
         content_f = content_f[0:1]
     else:
         if mask is not None:
-            feature = []
-            for part in range(1, 5):
-                cache = []
-                for batch in range(content_f.shape[0]):
-                    if switch_sig is not None and switch_sig[batch, part - 1] == 1:
-                        cache.append(adaptive_instance_normalization(style_f[batch,None] * mask_res[part], content_f[batch,None] * mask_res[part], mask_res[part]))
-                    else:
-                        cache.append(adaptive_instance_normalization(content_f[batch,None] * mask_res[part], style_f[batch,None] * mask_res[part], mask_res[part]))
-                feature.append(torch.cat(cache,dim=0))
-
-            feat = torch.sum(torch.stack(feature,dim=0),dim=0)
-
-
+            feat = adaptive_instance_normalization_parts(content_f, style_f, mask_res[1:], switch=switch_sig)
         else:
             feat = adaptive_instance_normalization(content_f, style_f)
     # print("feat ", feat)
@@ -80,79 +82,192 @@ def style_transfer(vgg, decoder, content, style, alpha=1.0,
     return decoder(feat)
 
 
-parser = argparse.ArgumentParser()
-# Basic options
-parser.add_argument('--content', type=str,
-                    help='File path to the content image')
-parser.add_argument('--content_dir', type=str,
-                    help='Directory path to a batch of content images')
-parser.add_argument('--style', type=str,
-                    help='File path to the style image, or multiple style \
-                    images separated by commas if you want to do style \
-                    interpolation or spatial control')
-parser.add_argument('--style_dir', type=str,
-                    help='Directory path to a batch of style images')
-parser.add_argument('--vgg', type=str, default='evo_trans/AdaIN/models/vgg_normalised.pth')
-parser.add_argument('--decoder', type=str, default='evo_trans/AdaIN/models/decoder.pth')
-
-# Additional options
-parser.add_argument('--content_size', type=int, default=512,
-                    help='New (minimum) size for the content image, \
-                    keeping the original size if set to 0')
-parser.add_argument('--style_size', type=int, default=512,
-                    help='New (minimum) size for the style image, \
-                    keeping the original size if set to 0')
-parser.add_argument('--crop', action='store_true',
-                    help='do center crop to create squared image')
-parser.add_argument('--mask', action='store_true',
-                    help='do center crop to create squared image')
-parser.add_argument('--save_ext', default='.jpg',
-                    help='The extension name of the output image')
-parser.add_argument('--output', type=str, default='output',
-                    help='Directory to save the output image(s)')
-
-# Advanced options
-parser.add_argument('--preserve_color', action='store_true',
-                    help='If specified, preserve color of the content image')
-parser.add_argument('--alpha', type=float, default=1.0,
-                    help='The weight that controls the degree of \
-                             stylization. Should be between 0 and 1')
-parser.add_argument(
-    '--style_interpolation_weights', type=str, default='',
-    help='The weight for blending the style of multiple style images')
-
-args = parser.parse_args()
-
-do_interpolation = False
-
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-
-decoder = net.decoder
-vgg = net.vgg
-
-decoder.eval()
-vgg.eval()
-
-decoder.load_state_dict(torch.load(args.decoder))
-vgg.load_state_dict(torch.load(args.vgg))
-vgg = nn.Sequential(*list(vgg.children())[:31])
-
-vgg.to(device)
-decoder.to(device)
-
-content_tf = test_transform(args.content_size, args.crop)
-style_tf = test_transform(args.style_size, args.crop)
+class StyleTransferSession(object):
+    """
+    Encodes a content/style batch once and caches the relu4_1 features and
+    the per-part AdaIN statistics, so that several switch-gate variants can
+    be generated while paying only for the masked mixing and the decoder.
+    """
+
+    def __init__(self, vgg, decoder, content, style, alpha=1.0, mask=None):
+        self.init_features(decoder, vgg(content), vgg(style), alpha, mask)
+
+    @classmethod
+    def from_features(cls, decoder, content_f, style_f, alpha=1.0, mask=None, content_stats=None, style_stats=None):
+        """
+        Session over relu4_1 features (and part statistics) computed elsewhere,
+        e.g. once per image and then paired.
+        """
+        session = cls.__new__(cls)
+        session.init_features(decoder, content_f, style_f, alpha, mask, content_stats, style_stats)
+        return session
+
+    def init_features(self, decoder, content_f, style_f, alpha=1.0, mask=None, content_stats=None, style_stats=None):
+        assert (0.0 <= alpha <= 1.0)
+        self.decoder = decoder
+        self.alpha = alpha
+        self.content_f = content_f
+        self.style_f = style_f
+        self.mask_res = None
+        if mask is not None:
+            self.mask_res = mask.to(self.content_f.device)
+            self.content_stats = content_stats or calc_mean_std_parts(self.content_f, self.mask_res[1:])
+            self.style_stats = style_stats or calc_mean_std_parts(self.style_f, self.mask_res[1:])
+
+    def generate(self, switch_sig=None):
+        content_f = self.content_f
+        if self.mask_res is None:
+            feat = adaptive_instance_normalization(content_f, self.style_f)
+            feat = feat * self.alpha + content_f * (1 - self.alpha)
+            return self.decoder(feat)
+
+        feat = adaptive_instance_normalization_parts(content_f, self.style_f, self.mask_res[1:], switch=switch_sig,
+                                                     content_stats=self.content_stats, style_stats=self.style_stats)
+        feat = feat * self.alpha + content_f * (1 - self.alpha) + content_f * self.mask_res[0]
+        return self.decoder(feat)
+
+    def sweep(self, chunk_size=None):
+        """
+        Decodes every switch-gate combination of every sample.
+        Returns N x 2^K x 3 x H x W images and the 2^K x K switch gates,
+        in the same order for every sample.
+        """
+        assert (self.mask_res is not None)
+        num_parts = self.mask_res.size(0) - 1
+        switches = torch.tensor(list(itertools.product([0, 1], repeat=num_parts)), device=self.content_f.device)
+        N, S = self.content_f.size(0), switches.size(0)
+        content_f = self.content_f.repeat_interleave(S, dim=0)
+        style_f = self.style_f.repeat_interleave(S, dim=0)
+        content_stats = [stat.repeat_interleave(S, dim=0) for stat in self.content_stats]
+        style_stats = [stat.repeat_interleave(S, dim=0) for stat in self.style_stats]
+        feat = adaptive_instance_normalization_parts(content_f, style_f, self.mask_res[1:], switch=switches.repeat(N, 1),
+                                                     content_stats=content_stats, style_stats=style_stats)
+        feat = feat * self.alpha + content_f * (1 - self.alpha) + content_f * self.mask_res[0]
+        if chunk_size:
+            output = torch.cat([self.decoder(chunk) for chunk in torch.split(feat, chunk_size, dim=0)], dim=0)
+        else:
+            output = self.decoder(feat)
+        return output.view(N, S, *output.shape[1:]), switches
 
-def do_adain(style, content, mask=None, switch_sig=None):
-    content = content_tf(content)#[3, 512, 1024]
-    style = style_tf(style)
-    if args.preserve_color:
-        style = coral(style, content)
-    with torch.no_grad():
-        output = style_transfer(vgg, decoder, content, style,
-                                args.alpha, mask=mask, switch_sig=switch_sig)
-    # print(output.shape)  # [1, 3, 512, 1024]
-    # output = output.cpu()
-    return output
 
+class StyleTransferEngine(object):
+    """
+    AdaIN vgg/decoder pair with an explicit configuration.
+    The weights are read on first use (or by load()), so creating an engine
+    and importing this module are cheap. An engine can be shared between
+    callers and threads.
+    """
+
+    def __init__(self, vgg_path='evo_trans/AdaIN/models/vgg_normalised.pth',
+                 decoder_path='evo_trans/AdaIN/models/decoder.pth',
+                 content_size=512, style_size=512, crop=False, alpha=1.0,
+                 preserve_color=False, device=None):
+        assert (0.0 <= alpha <= 1.0)
+        self.vgg_path = vgg_path
+        self.decoder_path = decoder_path
+        self.alpha = alpha
+        self.preserve_color = preserve_color
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.content_tf = test_transform(content_size, crop)
+        self.style_tf = test_transform(style_size, crop)
+        self.same_transform = content_size == style_size
+        self._vgg = None
+        self._decoder = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._vgg is None:
+                decoder = copy.deepcopy(net.decoder)
+                vgg = copy.deepcopy(net.vgg)
+                decoder.load_state_dict(torch.load(self.decoder_path, map_location='cpu'))
+                vgg.load_state_dict(torch.load(self.vgg_path, map_location='cpu'))
+                vgg = nn.Sequential(*list(vgg.children())[:31])
+                self._decoder = decoder.eval().to(self.device)
+                self._vgg = vgg.eval().to(self.device)
+        return self
+
+    def load_bundle(self, tensors, prefix='adain.'):
+        """
+        Binds the vgg/decoder to the tensors of a mapped bundle (see utils/bundle.py)
+        instead of reading the .pth files.
+        """
+        with self._lock:
+            decoder = copy.deepcopy(net.decoder)
+            vgg = nn.Sequential(*list(copy.deepcopy(net.vgg).children())[:31])
+            bundle.bind_module(decoder, tensors, prefix + 'decoder.')
+            bundle.bind_module(vgg, tensors, prefix + 'vgg.')
+            self._decoder = decoder.eval().to(self.device)
+            self._vgg = vgg.eval().to(self.device)
+        return self
+
+    def bundle_tensors(self, prefix='adain.'):
+        tensors = {}
+        for name, module in (('vgg', self.vgg), ('decoder', self.decoder)):
+            for key, value in module.state_dict().items():
+                tensors['%s%s.%s' % (prefix, name, key)] = value
+        return tensors
+
+    @property
+    def vgg(self):
+        return self.load()._vgg
+
+    @property
+    def decoder(self):
+        return self.load()._decoder
+
+    def to(self, device):
+        with self._lock:
+            self.device = torch.device(device)
+            if self._vgg is not None:
+                self._vgg.to(self.device)
+                self._decoder.to(self.device)
+        return self
+
+    def preprocess(self, style, content):
+        content = self.content_tf(content)#[3, 512, 1024]
+        style = self.style_tf(style)
+        if self.preserve_color:
+            style = coral(style, content)
+        return style, content
+
+    def features(self, images, style=False):
+        """
+        relu4_1 features of a batch preprocessed as content (or as style).
+        """
+        with torch.no_grad():
+            return self.vgg(self.style_tf(images) if style else self.content_tf(images))
+
+    def content_style_features(self, images):
+        """
+        (content, style) features of a batch; a single vgg pass when both
+        preprocess alike.
+        """
+        content_f = self.features(images)
+        return content_f, content_f if self.same_transform else self.features(images, style=True)
+
+    def transfer(self, style, content, mask=None, switch_sig=None):
+        style, content = self.preprocess(style, content)
+        with torch.no_grad():
+            output = style_transfer(self.vgg, self.decoder, content, style,
+                                    self.alpha, mask=mask, switch_sig=switch_sig)
+        return output
+
+    def session(self, style, content, mask=None):
+        style, content = self.preprocess(style, content)
+        with torch.no_grad():
+            session = StyleTransferSession(self.vgg, self.decoder, content, style, self.alpha, mask=mask)
+        return session
+
+
+_engine = None
+
+
+def do_adain(style, content, mask=None, switch_sig=None):
+    # entry point of the original script, kept for outside callers; runs on a default engine
+    global _engine
+    if _engine is None:
+        _engine = StyleTransferEngine()
+    return _engine.transfer(style, content, mask=mask, switch_sig=switch_sig)
@@ -2,31 +2,68 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import csv
+import json
 import os.path as osp
+import re
 import numpy as np
 
 import scipy.io as sio
 from absl import flags, app
 
 import torch
-from torch.utils.data import Dataset
-import imageio
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from PIL import Image
 import cv2
 import os
 from torch.utils.data import DataLoader
 
+from .image_cache import ImageCache
+
 
 # -------------- Dataset ------------- #
 # ------------------------------------ #
 
 
+def load_image_nobbox(img_path, img_size):
+    img = Image.open(img_path)
+    # Let the JPEG decoder downscale by a power of two while the long side stays >= img_size
+    scale = float(img_size) / max(img.size)
+    if scale < 1:
+        img.draft('RGB', (int(np.ceil(img.size[0] * scale)), int(np.ceil(img.size[1] * scale))))
+    # Some are grayscale:
+    img = np.asarray(img.convert('RGB'))
+    width, height, channel = img.shape
+    top, bottom, left, right = 0, 0, 0, 0
+    if width > height:
+        left = (width - height) // 2
+        right = left
+    else:
+        top = (height - width) // 2
+        bottom = top
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, 0)
+    img = cv2.resize(img, (img_size, img_size))
+    # Finally transpose the image to 3xHxW, uint8 until it reaches the model
+    img = np.transpose(img, (2, 0, 1))
+    return np.ascontiguousarray(img)
+
+
+def image_cache_from_opts(opts):
+    if opts.image_cache_mb <= 0:
+        return None
+    shape = (3, opts.img_size, opts.img_size) if opts.shared_image_cache else None
+    return ImageCache(opts.image_cache_mb * 2**20, shared_shape=shape)
+
+
 class TESTDataset(Dataset):
 
     def __init__(self, opts):
-        self.opts = opts
+        # only plain values are kept: absl FlagValues cannot be pickled for spawned loader workers
         np.random.seed(8)
         torch.manual_seed(8)
-        self.full_img_dir = self.opts.test_dir
+        self.full_img_dir = opts.test_dir
+        self.img_size = opts.img_size
+        self.image_cache = image_cache_from_opts(opts)
 
         self.pair_list = [
             ['3d930a4ba578463bbde6f7d53cb14e1e.jpg', '0c718004901643259a4fe8275a0b31d1.jpg'],
@@ -37,6 +74,8 @@ class TESTDataset(Dataset):
                 ]
 
         self.num_imgs = len(self.pair_list)
+        # drawn up front so the gates do not depend on which worker loads a pair
+        self.switch_sigs = (np.random.rand(self.num_imgs, 4) < 0.5).astype(int)
         return
 
     def __len__(self):
@@ -44,27 +83,16 @@ class TESTDataset(Dataset):
 
     def get_image_nobbox(self,path):
         img_path = osp.join(self.full_img_dir, path)
-        img = imageio.imread(img_path) / 255.0
-        # Some are grayscale:
-        if len(img.shape) == 2:
-            img = np.repeat(np.expand_dims(img, 2), 3, axis=2)
-        width, height, channel = img.shape
-        top, bottom, left, right = 0, 0, 0, 0
-        if width > height:
-            left = (width - height) // 2
-            right = left
-        else:
-            top = (height - width) // 2
-            bottom = top
-        img = cv2.copyMakeBorder(img, top, bottom, left, right, 0)
-        img = cv2.resize(img, (self.opts.img_size, self.opts.img_size))
-        # Finally transpose the image to 3xHxW
-        img = np.transpose(img, (2, 0, 1))
-        return img
+        if self.image_cache is None:
+            return self.load_image(img_path)
+        return self.image_cache.get(img_path, self.load_image)
+
+    def load_image(self, img_path):
+        return load_image_nobbox(img_path, self.img_size)
 
     def __getitem__(self, index):
         source_name, target_name = self.pair_list[index]
-        switch_sig = (np.random.rand(4)<0.5).astype(int)
+        switch_sig = self.switch_sigs[index]
         img = self.get_image_nobbox(source_name)
         img_t = self.get_image_nobbox(target_name)
 
@@ -74,13 +102,94 @@ class TESTDataset(Dataset):
         return elem
 
 
+class ManifestPairDataset(IterableDataset):
+    """
+    Streams (source, target) pairs from a manifest without loading it into memory.
+    CSV manifests need a header with source and target columns; JSONL manifests
+    have one object per line with the same keys. Spaces around keys and values
+    are ignored. Optional per-pair fields are
+    switch_sig (4 gates, e.g. "1010" or [1, 0, 1, 0]) and alpha (fuse weight, default 0).
+    Image paths are relative to opts.test_dir. Lines are split round-robin over
+    process ranks and loader workers.
+    """
+
+    def __init__(self, opts, manifest_path, rank=None, world_size=None):
+        self.full_img_dir = opts.test_dir
+        self.img_size = opts.img_size
+        self.image_cache = image_cache_from_opts(opts)
+        self.manifest_path = manifest_path
+        self.is_csv = not manifest_path.endswith(('.jsonl', '.json'))
+        self.rank = int(os.environ.get('RANK', 0)) if rank is None else rank
+        self.world_size = int(os.environ.get('WORLD_SIZE', 1)) if world_size is None else world_size
+
+    get_image_nobbox = TESTDataset.get_image_nobbox
+    load_image = TESTDataset.load_image
+
+    def parse(self):
+        """
+        Yields (line number, record) for every pair of the manifest, keys and
+        string values stripped.
+        """
+        with open(self.manifest_path, newline='' if self.is_csv else None) as f:
+            if self.is_csv:
+                reader = csv.DictReader(f)
+                records = ((reader.line_num, record) for record in reader)
+            else:
+                records = ((line_num, json.loads(line)) for line_num, line in enumerate(f, 1) if line.strip())
+            for line_num, record in records:
+                # extra csv fields are listed under None
+                yield line_num, {key.strip(): value.strip() if isinstance(value, str) else value
+                                 for key, value in record.items() if key is not None}
+
+    def records(self):
+        worker = get_worker_info()
+        num_workers, worker_id = (1, 0) if worker is None else (worker.num_workers, worker.id)
+        num_shards = self.world_size * num_workers
+        shard = self.rank * num_workers + worker_id
+        for index, (line_num, record) in enumerate(self.parse()):
+            if index % num_shards != shard:
+                continue
+            for key in ('source', 'target'):
+                if not record.get(key):
+                    raise ValueError('%s, line %d: missing %s' % (self.manifest_path, line_num, key))
+            yield index, record
+
+    def __iter__(self):
+        for index, record in self.records():
+            switch_sig = record.get('switch_sig')
+            if switch_sig is None or switch_sig == '':
+                switch_sig = np.random.RandomState(index).rand(4) < 0.5
+            elif isinstance(switch_sig, str):
+                switch_sig = [int(c) for c in re.findall('[01]', switch_sig)]
+            switch_sig = np.asarray(switch_sig).astype(int)
+            assert switch_sig.shape == (4,), 'switch_sig needs 4 gates (pair %d)' % index
+            alpha = record.get('alpha')
+            alpha = 0. if alpha is None or alpha == '' else float(alpha)
+            source_name, target_name = record['source'], record['target']
+            img = self.get_image_nobbox(source_name)
+            img_t = self.get_image_nobbox(target_name)
+            yield {'img': img, 'index': index, 'name': source_name, 'switch_sig': switch_sig,
+                   'img_t': img_t, 'index_t': index, 'name_t': target_name, 'alpha': alpha}
+
+
 #----------- Data Loader ----------#
 #----------------------------------#
 
 def test_loader(opts, shuffle=False):
-    return DataLoader(TESTDataset(opts),
+    # workers decode the next batches while the main process runs the models
+    kwargs = {}
+    if opts.num_workers > 0:
+        kwargs['prefetch_factor'] = opts.prefetch_factor
+    if opts.pair_manifest:
+        dataset = ManifestPairDataset(opts, opts.pair_manifest)
+        shuffle = False
+    else:
+        dataset = TESTDataset(opts)
+    return DataLoader(dataset,
                       batch_size=opts.batch_size,
                       shuffle=shuffle,
-                      num_workers=0,
-                      drop_last=True)
+                      num_workers=opts.num_workers,
+                      pin_memory=opts.pin_memory and torch.device(opts.device).type == 'cuda',
+                      drop_last=False,
+                      **kwargs)
 
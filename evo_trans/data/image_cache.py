@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import multiprocessing
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+
+
+class ImageCache(object):
+    """
+    LRU cache of preprocessed images keyed by (path, mtime), bounded by max_bytes.
+    By default every process keeps its own cache. With shared_shape set, the cache
+    is a fixed slab of slots of that shape in shared memory, created in the parent
+    process, so all loader workers read and fill the same cache.
+    """
+
+    def __init__(self, max_bytes, shared_shape=None, dtype=np.uint8):
+        self.max_bytes = max_bytes
+        self.shared = shared_shape is not None
+        if self.shared:
+            item_bytes = int(np.prod(shared_shape)) * np.dtype(dtype).itemsize
+            num_slots = max(1, int(max_bytes // item_bytes))
+            self.slab = torch.from_numpy(np.zeros((num_slots,) + tuple(shared_shape), dtype=dtype)).share_memory_()
+            self.keys = torch.full((num_slots,), -1, dtype=torch.int64).share_memory_()
+            self.stamps = torch.zeros(num_slots, dtype=torch.int64).share_memory_()
+            self.clock = torch.zeros(1, dtype=torch.int64).share_memory_()
+            self.lock = multiprocessing.Lock()
+        else:
+            self.items = collections.OrderedDict()
+            self.num_bytes = 0
+
+    @staticmethod
+    def key(path):
+        path = osp.abspath(path)
+        return path, os.stat(path).st_mtime_ns
+
+    def get(self, path, load):
+        """
+        Returns the cached image of path, calling load(path) on a miss.
+        """
+        key = self.key(path)
+        if self.shared:
+            return self._get_shared(key, path, load)
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+        img = load(path)
+        if img.nbytes <= self.max_bytes:
+            self.items[key] = img
+            self.num_bytes += img.nbytes
+            while self.num_bytes > self.max_bytes:
+                _, old = self.items.popitem(last=False)
+                self.num_bytes -= old.nbytes
+        return img
+
+    def _get_shared(self, key, path, load):
+        digest = hashlib.md5(repr(key).encode('utf-8')).digest()
+        # non-negative, so it never matches an empty slot
+        key_hash = int.from_bytes(digest[:8], 'little') >> 1
+        with self.lock:
+            slot = (self.keys == key_hash).nonzero()
+            if len(slot):
+                slot = int(slot[0])
+                self.clock += 1
+                self.stamps[slot] = self.clock[0]
+                return self.slab[slot].numpy().copy()
+        img = load(path)
+        assert img.shape == self.slab.shape[1:], 'shared cache expects images of shape %s' % (self.slab.shape[1:],)
+        with self.lock:
+            if not (self.keys == key_hash).any():
+                slot = int(self.stamps.argmin())
+                self.slab[slot] = torch.from_numpy(img)
+                self.keys[slot] = key_hash
+                self.clock += 1
+                self.stamps[slot] = self.clock[0]
+        return img
@@ -0,0 +1,197 @@
+"""
+Per-stage microbenchmarks of the test pipeline with random weights of the real shapes,
+so no checkpoint or pretrained download is needed. Prints (or writes) JSON results.
+
+python -m evo_trans.experiments.benchmark --device=cpu --bench_batch_sizes=1,5 \
+    --bench_threads=1,4 --bench_subdivide=3 --bench_output=bench.json
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import datetime
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from absl import app, flags
+
+from . import test_df2  # defines the model flags
+from ..AdaIN import net
+from ..AdaIN.function import adaptive_instance_normalization_parts, calc_mean_std_parts
+from ..AdaIN.test import part_masks_from_template, test_transform
+from ..nnutils import cub_deform2 as deform_net
+from ..nnutils import cub_mesh as mesh_net
+
+flags.DEFINE_list('bench_batch_sizes', ['1', '5'], 'Batch sizes to benchmark')
+flags.DEFINE_list('bench_threads', ['1'], 'torch intra-op thread counts to benchmark')
+flags.DEFINE_list('bench_subdivide', ['3'], 'Icosphere subdivision levels to benchmark')
+flags.DEFINE_list('bench_stages', [], 'Stages to run (default all)')
+flags.DEFINE_integer('bench_iters', 10, 'Timed iterations per stage')
+flags.DEFINE_integer('bench_warmup', 2, 'Untimed iterations per stage')
+flags.DEFINE_enum('bench_renderer', 'auto', ['auto', 'nmr', 'torch'],
+                  'Renderer to time: neural_renderer (cuda only), its pure torch port, or nmr when running on '
+                  'cuda with neural_renderer installed')
+flags.DEFINE_string('bench_output', '', 'Write the JSON results here instead of stdout')
+
+opts = flags.FLAGS
+
+STAGES = ['encoder', 'camera_head', 'texture_head', 'deformation', 'get_tex', 'vgg', 'masked_adain', 'decoder',
+          'render']
+
+
+def build_renderer(img_size, device):
+    name = opts.bench_renderer
+    if name == 'auto':
+        name = 'torch'
+        if device.type == 'cuda':
+            try:
+                import neural_renderer  # noqa: F401
+                name = 'nmr'
+            except ImportError:
+                pass
+    if name == 'nmr' and device.type != 'cuda':
+        raise ValueError('neural_renderer only renders on cuda, use --bench_renderer=torch on cpu')
+    # NeuralRenderer rasterizes with neural_renderer on cuda and with the torch port on cpu
+    renderer = test_df2.NeuralRenderer(img_size, device='cuda' if name == 'nmr' else 'cpu')
+    renderer.ambient_light_only()
+    renderer.set_bgcolor([1, 1, 1])
+    return renderer, name
+
+
+def build_models(subdivide):
+    model_opts = argparse.Namespace(**opts.flag_values_dict())
+    model_opts.subdivide = subdivide
+    model_opts.pretrained_resnet = False
+    device = torch.device(model_opts.device)
+    img_size = (model_opts.img_size, model_opts.img_size)
+    model_umr = mesh_net.MeshNet(img_size, model_opts, nz_feat=model_opts.nz_feat, axis=model_opts.axis).to(device)
+    model = deform_net.Dense_Gated_Net(model_opts, model_umr.num_output).to(device)
+    vgg = nn.Sequential(*list(copy.deepcopy(net.vgg).children())[:31]).to(device)
+    decoder = copy.deepcopy(net.decoder).to(device)
+    renderer, renderer_name = build_renderer(model_opts.img_size, device)
+    models = {
+        'umr': model_umr.eval(), 'df': model.eval(), 'vgg': vgg.eval(), 'decoder': decoder.eval(),
+        'renderer': renderer, 'renderer_name': renderer_name,
+        'tex_sampler': mesh_net.UVTextureSampler(model_umr.uv_sampler[0], model_umr.num_sym_faces),
+        'mean_shape_half': model_umr.mean_v.detach().clone(),
+        'faces': model_umr.faces.view(1, -1, 3),
+    }
+    return models
+
+
+def stage_fns(models, bs):
+    """
+    Builds random inputs of the real shapes for batch size bs and returns
+    {stage: fn}; each fn runs one stage on those inputs.
+    """
+    device = torch.device(opts.device)
+    model_umr, model = models['umr'], models['df']
+    imgs = torch.rand(bs, 3, opts.img_size, opts.img_size, device=device)
+    img_feat = model_umr.encoder(imgs)[0]
+    uv_sampler = model_umr.uv_sampler.expand(bs, -1, -1, -1)
+    outputs = model_umr.forward(imgs)
+    uv_images = torch.nn.functional.grid_sample(imgs, outputs['uvimage_pred'].permute(0, 2, 3, 1), align_corners=True)
+    cams = outputs['cam']
+    feat = outputs['noise'].unsqueeze(dim=2)
+    feat_t = torch.randn_like(feat)
+    verts = model.forward_pairs([(feat, feat_t)], models['mean_shape_half'])[0]['deformed_shape']
+    faces = models['faces'].expand(bs, -1, -1)
+    tex = models['tex_sampler'](uv_images)[..., None, :].expand(-1, -1, -1, -1, opts.tex_size, -1)
+    content = test_transform(512, False)(uv_images)
+    content_f = models['vgg'](content)
+    style_f = torch.randn_like(content_f)
+    template = np.random.RandomState(0).randint(0, 5, size=uv_images.shape[2:]).astype(np.uint8)
+    masks = part_masks_from_template(template, size=content_f.shape[2:]).to(device)
+    switch = torch.randint(0, 2, (bs, 4), device=device)
+
+    def masked_adain():
+        return adaptive_instance_normalization_parts(content_f, style_f, masks[1:], switch=switch,
+                                                     content_stats=calc_mean_std_parts(content_f, masks[1:]),
+                                                     style_stats=calc_mean_std_parts(style_f, masks[1:]))
+
+    return {
+        'encoder': lambda: model_umr.encoder(imgs),
+        'camera_head': lambda: model_umr.cam_predictor.forward(img_feat),
+        'texture_head': lambda: model_umr.texture_predictor(img_feat, uv_sampler),
+        'deformation': lambda: model.forward_pairs([(feat, feat), (feat_t, feat_t), (feat, feat_t)],
+                                                   models['mean_shape_half']),
+        'get_tex': lambda: models['tex_sampler'](uv_images),
+        'vgg': lambda: models['vgg'](content),
+        'masked_adain': masked_adain,
+        'decoder': lambda: models['decoder'](content_f),
+        'render': lambda: models['renderer'](verts, faces, cams, tex),
+    }
+
+
+def time_fn(fn, iters, warmup, device):
+    sync = torch.cuda.synchronize if device.type == 'cuda' else (lambda: None)
+    for _ in range(warmup):
+        fn()
+    sync()
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        sync()
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def main(_):
+    torch.manual_seed(0)
+    device = torch.device(opts.device)
+    if device.type == 'cuda':
+        torch.cuda.set_device(opts.gpu_id)
+    stages = opts.bench_stages or STAGES
+    results = []
+    renderer_name = None
+    with torch.no_grad():
+        for subdivide in map(int, opts.bench_subdivide):
+            models = build_models(subdivide)
+            renderer_name = models['renderer_name']
+            for threads in map(int, opts.bench_threads):
+                torch.set_num_threads(threads)
+                for bs in map(int, opts.bench_batch_sizes):
+                    fns = stage_fns(models, bs)
+                    for stage in stages:
+                        times = time_fn(fns[stage], opts.bench_iters, opts.bench_warmup, device)
+                        results.append({
+                            'stage': stage, 'subdivide': subdivide, 'threads': threads, 'batch_size': bs,
+                            'median_ms': float(np.median(times)), 'mean_ms': float(np.mean(times)),
+                            'min_ms': float(np.min(times)), 'max_ms': float(np.max(times)),
+                            'iters': opts.bench_iters,
+                        })
+                        # progress on stderr, so stdout is only the JSON report
+                        print(f'{stage:>13s} s={subdivide} threads={threads} bs={bs}: '
+                              f'{results[-1]["median_ms"]:.2f} ms', file=sys.stderr)
+    report = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'device': str(device),
+            'device_name': torch.cuda.get_device_name(device) if device.type == 'cuda' else platform.processor(),
+            'renderer': renderer_name,
+            'img_size': opts.img_size,
+            'tex_size': opts.tex_size,
+        },
+        'results': results,
+    }
+    if opts.bench_output:
+        with open(opts.bench_output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    app.run(main)
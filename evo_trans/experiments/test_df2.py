@@ -6,30 +6,45 @@ from PIL import Image
 from ..nnutils import cub_mesh as mesh_net
 from ..nnutils import cub_deform2 as deform_net
 from ..nnutils.nmr_pytorch import NeuralRenderer
+from ..nnutils import geom_utils
 from ..data import cub as cub_data
 from ..utils import tf_visualizer
+from ..utils import bundle
+from ..utils import artifact_cache
+from ..utils.image_writer import AsyncImageWriter
+from ..utils.mesh_export import MeshExporter
+from ..utils.compositor import Compositor
+from ..utils import mesh
 import os
 import time
 import numpy as np
 import os.path as osp
 from absl import app, flags
 from tqdm import tqdm
-import random
+import collections
+import copy
 import torch
 import torchvision
-import torchvision.utils as vutils
 import cv2
-from ..AdaIN.test import do_adain
+from ..AdaIN.test import StyleTransferEngine, StyleTransferSession, load_part_masks, part_masks_from_template
+from ..AdaIN.function import calc_mean_std_parts
 
 # Data:
 flags.DEFINE_string('stemp_path', 'evo_trans/cachedir/snapshots/cub_net/', 'path to semantic template.')
 flags.DEFINE_string('test_dir', 'test_data', 'test Data Directory')
+flags.DEFINE_string('pair_manifest', '', 'CSV or JSONL manifest of (source, target) pairs to stream, '
+                    'replacing the built-in test pairs')
 flags.DEFINE_integer('img_size', 256, 'image size')
 
 # Model:
 flags.DEFINE_boolean('pred_cam', True, 'If true predicts camera')
 flags.DEFINE_integer('axis', 1, 'symmetric axis')
 flags.DEFINE_string('df_path', 'evo_trans/cachedir/snapshots/ab79/et_net_latest.pth', 'model path')
+flags.DEFINE_string('adain_vgg_path', 'evo_trans/AdaIN/models/vgg_normalised.pth', 'AdaIN vgg encoder weights')
+flags.DEFINE_string('adain_decoder_path', 'evo_trans/AdaIN/models/decoder.pth', 'AdaIN decoder weights')
+flags.DEFINE_string('bundle_path', '', 'Load every weight and template from this single-file bundle instead of '
+                    'df_path, the AdaIN weights and stemp_path')
+flags.DEFINE_string('export_bundle', '', 'If set, write the loaded weights and templates to this bundle file')
 
 # Cub mesh:
 flags.DEFINE_boolean('symmetric', True, 'Use symmetric mesh or not')
@@ -48,6 +63,8 @@ flags.DEFINE_integer('tex_size', 6, 'Texture resolution per face')
 
 flags.DEFINE_integer('subdivide', 3, '# to subdivide icosahedron, 3=642verts, 4=2562 verts')
 
+flags.DEFINE_boolean('pretrained_resnet', True, 'Start the MeshNet ResNet from the torchvision ImageNet weights '
+                     '(overwritten by the checkpoint)')
 flags.DEFINE_boolean('use_deconv', False, 'If true uses Deconv')
 flags.DEFINE_string('upconv_mode', 'bilinear', 'upsample mode')
 
@@ -55,13 +72,45 @@ flags.DEFINE_string('upconv_mode', 'bilinear', 'upsample mode')
 curr_path = osp.dirname(osp.abspath(__file__))
 cache_path = osp.join(curr_path, '..', 'cachedir')
 flags.DEFINE_integer('gpu_id', 0, 'Which gpu to use')
+flags.DEFINE_string('device', 'cuda', 'Device to run the pipeline on (cuda or cpu)')
 flags.DEFINE_integer('batch_size', 5, 'Size of minibatches')
+flags.DEFINE_integer('num_workers', 4, 'Loader worker processes decoding images ahead of the models, 0 to load inline')
+flags.DEFINE_integer('prefetch_factor', 2, 'Batches each loader worker decodes ahead')
+flags.DEFINE_boolean('pin_memory', True, 'Stage loaded batches in pinned memory for async host-to-device copies')
+flags.DEFINE_integer('image_cache_mb', 256, 'Budget of the preprocessed image LRU cache in MB, 0 to disable')
+flags.DEFINE_boolean('shared_image_cache', False, 'Keep the image cache in shared memory, shared by all loader workers')
+flags.DEFINE_boolean('batch_encoder', True, 'Encode source and target images in a single MeshNet pass')
+flags.DEFINE_boolean('switch_sweep', False, 'Also render every switch-gate combination of each pair')
+flags.DEFINE_integer('sweep_chunk_size', 0, 'Max images per AdaIN decoder call in the switch sweep, 0 for one call')
+flags.DEFINE_integer('alpha_sweep', 0, 'If > 0, also render the evolved shape for this many alpha values in [-1, 1]')
+flags.DEFINE_integer('turntable_views', 0, 'If > 0, also render the evolved bird from this many azimuths')
+flags.DEFINE_float('turntable_elevation', 0, 'Elevation of the turntable views in degrees')
+flags.DEFINE_string('matrix_gallery', '', 'Image directory or list file (paths relative to test_dir); if set, '
+                    'renders the evolution of every gallery bird into every other one instead of the test pairs. '
+                    'The vgg features of every gallery image are kept in host memory (16 MB per image by default)')
+flags.DEFINE_integer('matrix_tile_mb', 4096, 'Memory budget of one tile of pairs in matrix mode')
+flags.DEFINE_boolean('headless', False, 'Only write the results, never open a preview window '
+                     '(implied when there is no DISPLAY on linux)')
+flags.DEFINE_enum('vis_format', 'jpg', ['jpg', 'png', 'webp'], 'Image format of the saved results')
+flags.DEFINE_integer('vis_quality', 95, 'JPEG/WebP quality of the saved results (1-100)')
+flags.DEFINE_integer('png_compression', 3, 'PNG compression level of the saved results (0-9)')
+flags.DEFINE_integer('writer_threads', 2, 'Background threads encoding and writing the results')
+flags.DEFINE_integer('writer_queue', 8, 'Results waiting to be written before inference blocks')
+flags.DEFINE_enum('export_meshes', '', ['', 'glb', 'ply'], 'Also save every evolved bird as a textured mesh '
+                  '(glTF binary or binary PLY) in vis_dir/meshes')
+flags.DEFINE_enum('mesh_texture_format', 'png', ['png', 'jpg'], 'Image format of the exported mesh textures')
 
 ## Flags for logging and snapshotting
 flags.DEFINE_string('checkpoint_dir', osp.join(cache_path, 'snapshots'),
                     'Directory where networks are saved')
 flags.DEFINE_string('vis_dir', osp.join(cache_path, 'visualization'),
                     'Root directory for visualizations')
+flags.DEFINE_string('topology_cache_dir', osp.join(cache_path, 'topology'),
+                    'Directory caching the symmetric mesh topology, empty to disable')
+flags.DEFINE_string('artifact_dir', '', 'Directory storing per-image MeshNet outputs (float16) so repeated images '
+                    'skip the encoder, empty to disable. The sampled camera and VAE noise are cached too, so an '
+                    'image keeps its first draw in every later run')
+flags.DEFINE_integer('artifact_cache_items', 1024, 'Per-image MeshNet outputs kept in memory in front of artifact_dir')
 
 opts = flags.FLAGS
 
@@ -72,12 +121,23 @@ class ShapenetTester():
         self.iteration_num=0
         self.opts = opts
         self.gpu_id = opts.gpu_id
-        torch.cuda.set_device(opts.gpu_id)
+        self.device = torch.device(opts.device)
+        if self.device.type == 'cuda':
+            torch.cuda.set_device(opts.gpu_id)
         if not os.path.exists(self.vis_dir):
             os.makedirs(self.vis_dir)
+        self.headless = opts.headless or (sys.platform.startswith('linux') and not os.environ.get('DISPLAY'))
+        self.compositor = Compositor(self.device)
+        self.writer = AsyncImageWriter(opts.vis_format, quality=opts.vis_quality,
+                                       png_compression=opts.png_compression,
+                                       num_threads=opts.writer_threads, max_queue=opts.writer_queue)
 
     def load(self):
-        dic = torch.load(self.opts.df_path)
+        if self.bundle is not None:
+            self.load_bundle()
+            self.init_artifacts()
+            return
+        dic = torch.load(self.opts.df_path, map_location=self.device)
         saved_state_dict = dic["umr"]
         unwanted_keys = {"noise", "uv_sampler"}
         new_params = self.model_umr.state_dict().copy()
@@ -86,60 +146,124 @@ class ShapenetTester():
                 new_params[name].copy_(saved_state_dict[name])
         self.model_umr.load_state_dict(new_params)
         self.model.load_state_dict(dic["df"])
+        self.style_engine.load()
         print(tf_visualizer.green("Loaded checkpoint from {}.".format(self.opts.df_path)))
+        self.init_artifacts()
+        if self.opts.export_bundle:
+            self.export_bundle(self.opts.export_bundle)
+
+    def init_artifacts(self):
+        self.artifacts = None
+        if self.opts.artifact_dir:
+            opts = self.opts
+            key = artifact_cache.checkpoint_hash(
+                [self.model_umr], extra=str((opts.img_size, opts.subdivide, opts.tex_size, opts.axis)))
+            self.artifacts = artifact_cache.ArtifactStore(opts.artifact_dir, key, opts.artifact_cache_items)
+
+    def export_bundle(self, path):
+        tensors = {}
+        for prefix, model in (('umr.', self.model_umr), ('df.', self.model)):
+            for name, value in model.state_dict().items():
+                tensors[prefix + name] = value
+        tensors.update(self.style_engine.bundle_tensors('adain.'))
+        tensors['mean_v'] = self.mean_shape_half
+        tensors['template.semantic_seg'] = np.array(Image.open(osp.join(self.opts.stemp_path, "semantic_seg.png")))
+        tensors['topology.faces'] = self.model_umr.faces
+        bundle.save_bundle(path, tensors)
+        self.check_bundle(path)
+        print(tf_visualizer.green("Exported bundle to {}.".format(path)))
+
+    def check_bundle(self, path):
+        # round trip: the written MeshNet weights must bind back onto a MeshNet unchanged
+        model_umr = copy.deepcopy(self.model_umr).cpu()
+        bundle.bind_module(model_umr, bundle.load_bundle(path), 'umr.')
+        loaded = model_umr.state_dict()
+        for name, value in self.model_umr.state_dict().items():
+            assert loaded[name].shape == value.shape and torch.equal(loaded[name], value.cpu()), \
+                'bundle round trip changed umr.%s' % name
+
+    def load_bundle(self):
+        # on cpu the weights stay views of the mapped file, on gpu they are copied once
+        tensors = self.bundle
+        bundle.bind_module(self.model_umr, tensors, 'umr.')
+        bundle.bind_module(self.model, tensors, 'df.')
+        self.style_engine.load_bundle(tensors, 'adain.')
+        assert tensors['topology.faces'].shape == self.model_umr.faces.shape, 'bundle built for another topology'
+        self.model_umr.faces = tensors['topology.faces'].to(self.device)
+        self.faces = self.model_umr.faces.view(1, -1, 3)
+        print(tf_visualizer.green("Loaded bundle from {}.".format(self.opts.bundle_path)))
 
     def define_model(self):
 
         opts = self.opts
-        self.avg_prob = torch.from_numpy(np.array(Image.open(osp.join(opts.stemp_path, "semantic_seg.png"))))
         # define model
         self.symmetric = opts.symmetric
         img_size = (opts.img_size, opts.img_size)
+        self.bundle = bundle.load_bundle(opts.bundle_path) if opts.bundle_path else None
         self.model_umr = mesh_net.MeshNet(
             img_size, opts, nz_feat=opts.nz_feat,
             axis=opts.axis,
-            temp_path=opts.stemp_path)
+            temp_path=opts.stemp_path if self.bundle is None else None)
 
         # load pretrained UMR model
-        self.model_umr = self.model_umr.cuda(device=opts.gpu_id)
+        self.model_umr = self.model_umr.to(self.device)
 
         ### build deformed model
-        self.model = deform_net.Dense_Gated_Net(opts, self.model_umr.num_output).cuda()
+        self.model = deform_net.Dense_Gated_Net(opts, self.model_umr.num_output).to(self.device)
+        self.style_engine = StyleTransferEngine(vgg_path=opts.adain_vgg_path, decoder_path=opts.adain_decoder_path,
+                                                device=self.device)
+        if self.bundle is None:
+            self.part_masks = load_part_masks(osp.join(opts.stemp_path, "semantic_seg.png"), device=self.device)
+        else:
+            self.part_masks = part_masks_from_template(self.bundle['template.semantic_seg']).to(self.device)
         torch.backends.cudnn.benchmark = False
         torch.backends.cudnn.deterministic = True
-        faces = self.model_umr.faces.view(1, -1, 3)
+        # 1 x F x 3, expanded to the batch at render time
+        self.faces = self.model_umr.faces.view(1, -1, 3)
         mean = self.model_umr.get_mean_shape()
-        self.faces = faces.repeat(opts.batch_size, 1, 1)
+        self.tex_sampler = mesh_net.UVTextureSampler(self.model_umr.uv_sampler[0], self.model_umr.num_sym_faces)
+        self.mesh_exporter = None
+        if opts.export_meshes:
+            topology = mesh.load_symmetric_topology(opts.subdivide, axis=opts.axis, cache_dir=opts.topology_cache_dir)
+            self.mesh_exporter = MeshExporter(topology['verts'], topology['faces'], topology['num_sym_faces'],
+                                              fmt=opts.export_meshes, image_format=opts.mesh_texture_format)
+            self.mesh_dir = osp.join(self.vis_dir, 'meshes')
+            if not os.path.exists(self.mesh_dir):
+                os.makedirs(self.mesh_dir)
         self.mean_shape = mean
 
         # define renderers
-        self.vis_renderer = NeuralRenderer(opts.img_size)
+        self.vis_renderer = NeuralRenderer(opts.img_size, device=self.device)
         self.vis_renderer.ambient_light_only()
         self.vis_renderer.set_bgcolor([1, 1, 1])
         self.vis_renderer.set_light_dir([0, 1, -1], 0.4)
         self.iter_time = 0
 
         # load half mean shape
-        self.mean_shape_half = torch.load(osp.join(opts.stemp_path, "mean_v.pth"),
-                                     map_location=lambda storage, loc: storage.cuda(opts.gpu_id))
+        if self.bundle is None:
+            self.mean_shape_half = torch.load(osp.join(opts.stemp_path, "mean_v.pth"),
+                                         map_location=self.device)
+        else:
+            self.mean_shape_half = self.bundle['mean_v'].to(self.device)
         self.vis_batch = None
+        self.resnet_transform = torchvision.transforms.Normalize(
+            mean=[0.485, 0.456, 0.406],
+            std=[0.229, 0.224, 0.225])
         return
 
     def init_dataset(self):
         opts = self.opts
         self.data_module = cub_data
         self.dataloader = self.data_module.test_loader(opts, shuffle=False)
-        self.resnet_transform = torchvision.transforms.Normalize(
-            mean=[0.485, 0.456, 0.406],
-            std=[0.229, 0.224, 0.225])
     
     def set_input(self, batch):
         opts = self.opts
         # =================================================================================== #
         #                               Load source images                                    #
         # =================================================================================== #
-        self.input_imgs = batch['img'].type(torch.FloatTensor).cuda()
-        self.input_imgs_t = batch['img_t'].type(torch.FloatTensor).cuda()
+        # uint8 from the loader, converted to [0, 1] floats on the model device
+        self.input_imgs = batch['img'].to(self.device, non_blocking=True).float().div_(255)
+        self.input_imgs_t = batch['img_t'].to(self.device, non_blocking=True).float().div_(255)
         self.imgs = self.input_imgs.clone()
         for b in range(self.input_imgs.size(0)):
             self.input_imgs[b] = self.resnet_transform(self.input_imgs[b])
@@ -151,20 +275,27 @@ class ShapenetTester():
         self.name = batch['name']
         self.name_t = batch['name_t']
         self.switch_sig = batch['switch_sig']
+        if self.artifacts is not None:
+            self.img_keys = [artifact_cache.image_hash(img) for img in batch['img'].numpy()]
+            self.img_keys_t = [artifact_cache.image_hash(img) for img in batch['img_t'].numpy()]
+        self.alpha = batch['alpha'].float().to(self.device) if 'alpha' in batch else 0
 
     def get_current_visuals(self):
         self.curr_time = time.time()
         with torch.no_grad():
-            outputs_t = self.model_umr.forward(self.input_imgs_t)
-            outputs = self.model_umr.forward(self.input_imgs)
-            img_feat = outputs['noise']
-            img_feat_t = outputs_t['noise']
-            output_df = self.model.forward(img_feat.unsqueeze(dim=2), img_feat.unsqueeze(dim=2),
-                                           self.mean_shape_half)
-            output_df_t = self.model.forward(img_feat_t.unsqueeze(dim=2), img_feat_t.unsqueeze(dim=2),
-                                             self.mean_shape_half)
-            output_df_d = self.model.forward(img_feat.unsqueeze(dim=2), img_feat_t.unsqueeze(dim=2),
-                                             self.mean_shape_half)
+            if self.artifacts is not None:
+                outputs_t, outputs = self.cached_forward([(self.input_imgs_t, self.img_keys_t),
+                                                          (self.input_imgs, self.img_keys)])
+            elif self.opts.batch_encoder:
+                outputs_t, outputs = self.model_umr.forward_split([self.input_imgs_t, self.input_imgs])
+            else:
+                outputs_t = self.model_umr.forward(self.input_imgs_t)
+                outputs = self.model_umr.forward(self.input_imgs)
+            img_feat = outputs['noise'].unsqueeze(dim=2)
+            img_feat_t = outputs_t['noise'].unsqueeze(dim=2)
+            output_df, output_df_t, output_df_d = self.model.forward_pairs(
+                [(img_feat, img_feat), (img_feat_t, img_feat_t), (img_feat, img_feat_t, self.alpha)],
+                self.mean_shape_half)
             proj_cam = outputs['cam'].detach()
             pred_vs = output_df['deformed_shape']
             pred_vs_t = output_df_t['deformed_shape']
@@ -175,16 +306,18 @@ class ShapenetTester():
             uv_images_t = torch.nn.functional.grid_sample(self.imgs_t, uv_flows_t, align_corners=True)
             image_recon_s = self.mesh_render(pred_vs, proj_cam, uv_images)
             image_recon_t = self.mesh_render(pred_vs_t, proj_cam, uv_images_t)
-            uv_images_evo_1 = self.generate(uv_images, uv_images_t, self.avg_prob[None], switch_sig=self.switch_sig)
+            # encode the uv images once and reuse the features for every switch gate
+            adain = self.style_engine.session(uv_images, uv_images_t, self.part_masks)
+            uv_images_evo_1 = adain.generate(switch_sig=self.switch_sig)
             image_evo_1 = self.mesh_render(pred_vs_d, proj_cam, uv_images_evo_1)
             self.switch_sig_2 = self.switch_sig[torch.randperm(self.switch_sig.size(0))]
-            uv_images_evo_2 = self.generate(uv_images, uv_images_t, self.avg_prob[None], switch_sig=self.switch_sig_2)
+            uv_images_evo_2 = adain.generate(switch_sig=self.switch_sig_2)
             image_evo_2 = self.mesh_render(pred_vs_d, proj_cam, uv_images_evo_2)
             self.switch_sig_3 = self.switch_sig[torch.randperm(self.switch_sig.size(0))]
-            uv_images_evo_3 = self.generate(uv_images, uv_images_t, self.avg_prob[None], switch_sig=self.switch_sig_3)
+            uv_images_evo_3 = adain.generate(switch_sig=self.switch_sig_3)
             image_evo_3 = self.mesh_render(pred_vs_d, proj_cam, uv_images_evo_3)
             self.switch_sig_4 = self.switch_sig[torch.randperm(self.switch_sig.size(0))]
-            uv_images_evo_4 = self.generate(uv_images, uv_images_t, self.avg_prob[None], switch_sig=self.switch_sig_4)
+            uv_images_evo_4 = adain.generate(switch_sig=self.switch_sig_4)
             image_evo_4 = self.mesh_render(pred_vs_d, proj_cam, uv_images_evo_4)
             vis_dict = {}
             vis_dict[f'vis_{self.curr_time}'] = torch.cat(
@@ -198,45 +331,125 @@ class ShapenetTester():
                 image_recon_t,
                 self.imgs_t,
                 ], dim=3)
+            if self.mesh_exporter is not None:
+                names = [f'{osp.splitext(osp.basename(name))[0]}_to_{osp.splitext(osp.basename(name_t))[0]}'
+                         for name, name_t in zip(self.name, self.name_t)]
+                self.export_meshes(names, pred_vs_d, uv_images_evo_1, uv_images.shape[2:])
+            if self.opts.switch_sweep:
+                vis_dict[f'sweep_{self.curr_time}'] = self.sweep_switch_gates(adain, pred_vs_d, proj_cam)
+            if self.opts.alpha_sweep > 0:
+                vis_dict[f'alpha_{self.curr_time}'] = self.sweep_alpha(img_feat, img_feat_t, proj_cam, uv_images_evo_1)
+            if self.opts.turntable_views > 0:
+                vis_dict[f'turntable_{self.curr_time}'] = self.turntable(pred_vs_d, proj_cam, uv_images_evo_1)
             return vis_dict
 
+    def cached_forward(self, batches):
+        """
+        MeshNet outputs for a list of (images, image keys) batches.
+        Images found in the artifact store skip the network; the others
+        (each distinct image once) go through a single forward pass.
+        """
+        names = ('noise', 'cam', 'uvimage_pred', 'tex_flow')
+        found = {}
+        missing = collections.OrderedDict()
+        for imgs, keys in batches:
+            for img, key in zip(imgs, keys):
+                if key not in found and key not in missing:
+                    artifacts = self.artifacts.get(key)
+                    if artifacts is None:
+                        missing[key] = img
+                    else:
+                        found[key] = artifacts
+        if missing:
+            outputs = self.model_umr.forward(torch.stack(list(missing.values()), dim=0))
+            for i, key in enumerate(missing):
+                found[key] = self.artifacts.put(key, {name: outputs[name][i] for name in names})
+        return [{name: torch.stack([found[key][name] for key in keys], dim=0).to(self.device).float()
+                 for name in names}
+                for _, keys in batches]
+
+    def export_meshes(self, names, verts, uv_images, size):
+        # the texture is the uv image at the MeshNet uv resolution (size);
+        # only the copy to the cpu happens here, the files are written by the writer threads
+        verts = verts.detach().float().cpu().numpy()
+        if uv_images.shape[2:] != size:
+            uv_images = torch.nn.functional.interpolate(uv_images, size=tuple(size), mode='area')
+        textures = uv_images.detach().clamp(0, 1).mul(255).add_(0.5).permute(0, 2, 3, 1).to('cpu', torch.uint8).numpy()
+        for name, v, texture in zip(names, verts, textures):
+            self.writer.submit_call(self.mesh_exporter.export, osp.join(self.mesh_dir, name), v, texture)
+
+    def turntable(self, verts, cams, uv_images):
+        # renders each mesh from evenly spaced azimuths, one row per pair
+        num_views = self.opts.turntable_views
+        azimuth = torch.arange(num_views, dtype=torch.float32) * (2 * np.pi / num_views)
+        elevation = torch.full((num_views,), np.deg2rad(self.opts.turntable_elevation), dtype=torch.float32)
+        view_quats = geom_utils.azimuth_elevation_quat(azimuth, elevation)
+        images = self.mesh_render_views(verts, cams, uv_images, view_quats)
+        return torch.cat(images.unbind(dim=1), dim=3)
+
+    def sweep_alpha(self, img_feat, img_feat_t, cams, uv_images):
+        # renders the evolved shape for evenly spaced alpha values, one row per pair
+        alphas = torch.linspace(-1, 1, self.opts.alpha_sweep)
+        pred_vs = self.model.forward_alpha(img_feat, img_feat_t, self.mean_shape_half, alphas)
+        bs, num_alphas = pred_vs.shape[:2]
+        images = self.mesh_render(pred_vs.view(bs * num_alphas, -1, 3), cams.repeat_interleave(num_alphas, dim=0),
+                                  uv_images.repeat_interleave(num_alphas, dim=0))
+        images = images.view(bs, num_alphas, *images.shape[1:])
+        return torch.cat(images.unbind(dim=1), dim=3)
+
+    def sweep_switch_gates(self, adain, verts, cams):
+        # renders all 2^K texture mixes of each pair on its evolved shape, one row per pair
+        uv_images_sweep, self.sweep_switches = adain.sweep(chunk_size=self.opts.sweep_chunk_size)
+        bs, num_sw = uv_images_sweep.shape[:2]
+        images = self.mesh_render(verts.repeat_interleave(num_sw, dim=0), cams.repeat_interleave(num_sw, dim=0),
+                                  uv_images_sweep.view(bs * num_sw, *uv_images_sweep.shape[2:]))
+        images = images.view(bs, num_sw, *images.shape[1:])
+        return torch.cat(images.unbind(dim=1), dim=3)
+
     def mesh_render(self, verts, cams, uv_images):
-        tex = self.get_tex(uv_images)[..., None, :].repeat(1, 1, 1, 1, opts.tex_size, 1)
-        image_pred = self.vis_renderer(verts.detach(), self.faces, cams.detach(), tex)
+        # the renderer copies the textures (fill_back), so a broadcast view is enough here
+        tex = self.get_tex(uv_images)[..., None, :].expand(-1, -1, -1, -1, opts.tex_size, -1)
+        faces = self.faces.expand(verts.size(0), -1, -1)
+        image_pred = self.vis_renderer(verts.detach(), faces, cams.detach(), tex)
         return image_pred
 
-    def get_tex(self,uv_images):
-        uv_sampler = self.model_umr.uv_sampler
-        tex = torch.nn.functional.grid_sample(uv_images, uv_sampler, align_corners=True)
-        nb, nf, _, nc = tex.size()
-        self.F = uv_sampler.size(1)
-        tex = tex.view(tex.size(0), -1, self.F, 6, 6).permute(0, 2, 3, 4, 1)
-        tex_left = tex[:, -self.model_umr.num_sym_faces:]
-        tex_all = torch.cat([tex, tex_left], 1)
-        return tex_all
-    
-    def generate(self, style, content, mask=None, switch_sig=None):
-        result = do_adain(style, content, mask=mask, switch_sig=switch_sig)
-        return result
+    def mesh_render_views(self, verts, cams, uv_images, view_quats):
+        # the renderer copies the textures (fill_back), so a broadcast view is enough here
+        tex = self.get_tex(uv_images)[..., None, :].expand(-1, -1, -1, -1, opts.tex_size, -1)
+        faces = self.faces.expand(verts.size(0), -1, -1)
+        return self.vis_renderer.render_views(verts.detach(), faces, cams.detach(), tex, view_quats)
 
-    def putText(self, img, text, position, font=cv2.FONT_HERSHEY_SIMPLEX, font_size=1, color=(0, 0, 0), thickness=2):
-        img = cv2.putText(img, text, position, font, font_size, color, thickness, cv2.LINE_AA)
-        return img
+    def get_tex(self,uv_images):
+        return self.tex_sampler(uv_images)
 
-    def add_text(self, img):
-        h_int, w_int = img.shape[0]//5, img.shape[1]//8
-        SW = [self.switch_sig, self.switch_sig_2, self.switch_sig_3, self.switch_sig_4]
+    def compose(self, k, v, SW):
+        """
+        Lays out a vis_dict entry (one row per pair) on its device and returns the
+        BGR uint8 image. The result panels (vis_) also get the switch gates of the
+        evolved panels and a label footer; text is sized for 256 pixel panels.
+        """
+        img = self.compositor.grid(v, nrow=1)
+        if not k.startswith('vis_'):
+            return self.compositor.to_bgr_uint8(img)
+        labels = ['Source', 'Recon_s', 'Ours_1', 'Ours_2','Ours_3', 'Ours_4', 'Recon_t', 'Target']
+        pad = self.compositor.padding
+        rows, _, H, W = v.shape
+        w_int = W // len(labels)
+        scale = w_int / 256.
+        texts = []
         # write switch gate [head,neck,back,belly]
-        for row in range(5):
+        for row in range(rows):
             for column in range(2, 6):
-                img = self.putText(img, f'SW={SW[column-2][row].tolist()}', (20 + w_int * column, 240 + h_int * row), font_size=0.8, color=(125,125,125))
-
+                texts.append((f'SW={SW[column-2][row].tolist()}',
+                              (pad + w_int * column + round(18 * scale), pad + (H + pad) * row + H - round(18 * scale)),
+                              0.8 * scale, (125, 125, 125)))
         # write label
-        img = cv2.copyMakeBorder(img, 0, 100, 0, 0, cv2.BORDER_CONSTANT, value=[255, 255, 255])
-        labels = ['Source', 'Recon_s', 'Ours_1', 'Ours_2','Ours_3', 'Ours_4', 'Recon_t', 'Target']
-        for i, label in enumerate(labels, 0):
-            img = self.putText(img, label, (45+w_int*i, 1360), font_size=1.5)
-        return img
+        footer = round(100 * scale)
+        label_y = img.size(1) + round(68 * scale)
+        img = torch.cat([img, img.new_ones(3, footer, img.size(2))], dim=1)
+        for i, label in enumerate(labels):
+            texts.append((label, (pad + w_int * i + round(43 * scale), label_y), 1.5 * scale, (0, 0, 0)))
+        return self.compositor.to_bgr_uint8(self.compositor.overlay(img, texts))
 
     def test(self):
         opts = self.opts
@@ -247,26 +460,144 @@ class ShapenetTester():
                 self.set_input(batch)
                 self.iteration_num += 1
                 vis_dict = self.get_current_visuals()
+                SW = [self.switch_sig, self.switch_sig_2, self.switch_sig_3, self.switch_sig_4]
                 for k, v in vis_dict.items():
-                    res = vutils.make_grid(v,nrow=1).mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to('cpu', torch.uint8).numpy()
-                    img = cv2.cvtColor(res, cv2.COLOR_BGR2RGB)
-                    img = self.add_text(img)
+                    res = self.compose(k, v, SW)
+                    if self.headless:
+                        self.writer.submit(osp.join(self.vis_dir, k), res, is_bgr=True)
+                        continue
+                    img = self.writer.write(osp.join(self.vis_dir, k), res, is_bgr=True)
                     img_small = cv2.resize(img, (img.shape[1]//2,img.shape[0]//2))
-                    cv2.imwrite(osp.join(self.vis_dir, f'{k}.jpg'), img)
                     cv2.imshow('image', img_small)
                     cv2.waitKey(0)
 
                 del vis_dict
                 print(tf_visualizer.green(f"({self.iteration_num}) Visualization saved at {self.vis_dir}."))
 
+    def load_gallery(self):
+        path = self.opts.matrix_gallery
+        if osp.isdir(path):
+            names = sorted(name for name in os.listdir(path) if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+            return [osp.join(path, name) for name in names]
+        with open(path) as f:
+            return [osp.join(self.opts.test_dir, line.strip()) for line in f if line.strip()]
+
+    def encode_gallery(self, paths):
+        """
+        Runs everything that depends on a single image once per gallery image:
+        MeshNet, the shape projector, the AdaIN vgg features and their part
+        statistics. Images, uv textures and vgg features are kept on the cpu.
+        """
+        opts = self.opts
+        masks = self.part_masks[1:]
+        gallery = collections.defaultdict(list)
+        for start in range(0, len(paths), opts.batch_size):
+            imgs_u8 = torch.from_numpy(np.stack([cub_data.load_image_nobbox(path, opts.img_size)
+                                                 for path in paths[start:start + opts.batch_size]]))
+            imgs = imgs_u8.to(self.device).float().div_(255)
+            input_imgs = torch.stack([self.resnet_transform(img) for img in imgs], dim=0)
+            if self.artifacts is not None:
+                keys = [artifact_cache.image_hash(img) for img in imgs_u8.numpy()]
+                outputs, = self.cached_forward([(input_imgs, keys)])
+            else:
+                outputs = self.model_umr.forward(input_imgs)
+            uv_images = torch.nn.functional.grid_sample(imgs, outputs['uvimage_pred'].permute(0, 2, 3, 1),
+                                                        align_corners=True)
+            content_f, style_f = self.style_engine.content_style_features(uv_images)
+            content_mean, content_std = calc_mean_std_parts(content_f, masks)
+            style_mean, style_std = calc_mean_std_parts(style_f, masks)
+            gallery['content_f'].append(content_f.cpu())
+            if style_f is not content_f:
+                gallery['style_f'].append(style_f.cpu())
+            gallery['imgs'].append(imgs.cpu())
+            gallery['uv_images'].append(uv_images.cpu())
+            gallery['cams'].append(outputs['cam'])
+            gallery['projected'].append(self.model.projector(outputs['noise'].unsqueeze(dim=2)))
+            gallery['content_mean'].append(content_mean)
+            gallery['content_std'].append(content_std)
+            gallery['style_mean'].append(style_mean)
+            gallery['style_std'].append(style_std)
+        gallery = {k: torch.cat(v, dim=0) for k, v in gallery.items()}
+        gallery.setdefault('style_f', gallery['content_f'])
+        return gallery
+
+    def matrix_tile_size(self):
+        # a pair holds its content and style features, the part mixing maps and the
+        # decoder activations, about 16 relu4_1-sized float maps
+        H, W = self.part_masks.shape[1:]
+        pair_bytes = 16 * 512 * H * W * 4
+        return max(1, int(np.sqrt(self.opts.matrix_tile_mb * 2**20 // pair_bytes)))
+
+    def matrix_tile(self, gallery, rows, cols):
+        """
+        Evolves every gallery bird in rows (source) into every bird in cols (target).
+        Returns the tile images, row-major: the targets along the top and
+        the sources down the left.
+        """
+        K = gallery['cams'].size(0)
+        src = rows.repeat_interleave(len(cols))
+        tgt = cols.repeat(len(rows))
+        pred_vs = self.model.forward_projected(gallery['projected'][src], gallery['projected'][tgt],
+                                               self.mean_shape_half)
+        style_f = gallery['style_f'][rows].to(self.device)
+        content_f = gallery['content_f'][cols].to(self.device)
+        adain = StyleTransferSession.from_features(
+            self.style_engine.decoder,
+            content_f.repeat(len(rows), 1, 1, 1),
+            style_f.repeat_interleave(len(cols), dim=0),
+            self.style_engine.alpha, self.part_masks,
+            content_stats=(gallery['content_mean'][tgt], gallery['content_std'][tgt]),
+            style_stats=(gallery['style_mean'][src], gallery['style_std'][src]))
+        # the same gates for a pair whatever the tiling
+        switch_sig = torch.from_numpy(np.stack([
+            (np.random.RandomState(int(i) * K + int(j)).rand(4) < 0.5).astype(int) for i, j in zip(src, tgt)]))
+        uv_images_evo = adain.generate(switch_sig=switch_sig)
+        if self.mesh_exporter is not None:
+            self.export_meshes([f'{gallery["names"][i]}_to_{gallery["names"][j]}' for i, j in zip(src, tgt)],
+                               pred_vs, uv_images_evo, gallery['uv_images'].shape[2:])
+        image_evo = self.mesh_render(pred_vs, gallery['cams'][src], uv_images_evo).cpu()
+        image_evo = image_evo.view(len(rows), len(cols), *image_evo.shape[1:])
+        header = torch.cat([torch.ones_like(image_evo[0, :1]), gallery['imgs'][cols]], dim=0)
+        body = torch.cat([gallery['imgs'][rows].unsqueeze(1), image_evo], dim=1)
+        return torch.cat([header, body.flatten(0, 1)], dim=0)
+
+    def test_matrix(self):
+        self.model_umr.eval()
+        self.model.eval()
+        paths = self.load_gallery()
+        K = len(paths)
+        with torch.no_grad():
+            gallery = self.encode_gallery(paths)
+            gallery['names'] = [osp.splitext(osp.basename(path))[0] for path in paths]
+            tile = self.matrix_tile_size()
+            for row in tqdm(range(0, K, tile)):
+                for col in range(0, K, tile):
+                    rows = torch.arange(row, min(row + tile, K))
+                    cols = torch.arange(col, min(col + tile, K))
+                    self.write_grid(f'matrix_{row:05d}_{col:05d}', self.matrix_tile(gallery, rows, cols),
+                                    nrow=len(cols) + 1)
+        print(tf_visualizer.green(f"{K}x{K} evolution matrix saved at {self.vis_dir}."))
+
+    def write_grid(self, name, images, nrow):
+        res = self.compositor.to_bgr_uint8(self.compositor.grid(images, nrow=nrow))
+        self.writer.submit(osp.join(self.vis_dir, name), res, is_bgr=True)
+
 def main(_):
     torch.manual_seed(0)
     tester = ShapenetTester(opts)
     tester.define_model()
-    tester.init_dataset()
+    if not opts.matrix_gallery:
+        tester.init_dataset()
     tester.load()
     print(tf_visualizer.blue('Start testing...'))
-    tester.test()
+    # the queued results are written (and writer errors raised) even if the run fails
+    try:
+        if opts.matrix_gallery:
+            tester.test_matrix()
+        else:
+            tester.test()
+    finally:
+        tester.writer.close()
 
 
 if __name__ == '__main__':
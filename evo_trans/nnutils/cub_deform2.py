@@ -81,12 +81,10 @@ class Dense_Gated_Net(nn.Module):
         self.symmetric = opts.symmetric
         self.num_half_verts = num_half_verts
         self.init_networks()
-        verts, faces = mesh.create_sphere(opts.subdivide)
         if self.symmetric:
-            _, _, _, num_sym, _, _ = mesh.make_symmetric(verts, faces,
-                                                                                                  axis=0)
-            self.num_sym = num_sym
-        self.flip = torch.ones(1, 3).cuda()
+            topology = mesh.load_symmetric_topology(opts.subdivide, axis=0, cache_dir=opts.topology_cache_dir)
+            self.num_sym = topology['num_sym']
+        self.flip = torch.ones(1, 3).to(torch.device(opts.device))
         self.flip[0, 1] = -1
 
 
@@ -127,16 +125,7 @@ class Dense_Gated_Net(nn.Module):
             return V
             # 337, 3
 
-    def forward(self, source_feat, target_feat, mean_shape_half):
-        self.target_feat = target_feat
-        self.source_feat = source_feat
-        self.delta_res = torch.autograd.Variable(torch.zeros(source_feat.shape[0], self.num_half_verts, 3),
-                                                 requires_grad=True)
-        self.delta_res = self.delta_res.cuda()
-        bs, _, _ = self.delta_res.shape
-        mean_shape_half = mean_shape_half.unsqueeze(dim=0).repeat(bs, 1, 1).transpose(1, 2)
-        s = self.projector(self.source_feat)
-        t = self.projector(self.target_feat)
+    def gate(self, s, t):
         s, t, gate_1 = self.gate_layer_1(s, t)
         s, t, gate_2 = self.gate_layer_2(s, t, gate_prev = gate_1)
         s, t, gate_3 = self.gate_layer_3(s, t, gate_prev = gate_2)
@@ -145,7 +134,20 @@ class Dense_Gated_Net(nn.Module):
         s, t, gate_6 = self.gate_layer_6(s, t, gate_prev = gate_5)
         s, t, gate_7 = self.gate_layer_7(s, t, gate_prev = gate_6)
         s, t, gate_8 = self.gate_layer_8(s, t, gate_prev = gate_7)
-        fused_feat = nn.ReLU()(self.fuse_layer(s,t))
+        return s, t
+
+    def forward(self, source_feat, target_feat, mean_shape_half, alpha_weight=0):
+        self.target_feat = target_feat
+        self.source_feat = source_feat
+        self.delta_res = torch.autograd.Variable(torch.zeros(source_feat.shape[0], self.num_half_verts, 3),
+                                                 requires_grad=True)
+        self.delta_res = self.delta_res.to(source_feat.device)
+        bs, _, _ = self.delta_res.shape
+        mean_shape_half = mean_shape_half.unsqueeze(dim=0).repeat(bs, 1, 1).transpose(1, 2)
+        s = self.projector(self.source_feat)
+        t = self.projector(self.target_feat)
+        s, t = self.gate(s, t)
+        fused_feat = nn.ReLU()(self.fuse_layer(s, t, alpha_weight))
         delta_flow = self.shape_predictor(fused_feat)
         self.delta_res = self.delta_res + delta_flow
 
@@ -157,3 +159,61 @@ class Dense_Gated_Net(nn.Module):
         }
 
         return outputs
+
+    def forward_pairs(self, pairs, mean_shape_half):
+        """
+        Evaluates a list of (source_feat, target_feat) pairs as one stacked batch.
+        A pair may carry a third element, its fuse weight (alpha): a number or
+        one value per sample. Features shared between pairs (the same tensor
+        object) go through the projector only once.
+        Returns one output dict per pair.
+        """
+        pairs = [tuple(pair) + (0,) * (3 - len(pair)) for pair in pairs]
+        feats = []
+        feat_inds = {}
+        for pair in pairs:
+            for feat in pair[:2]:
+                if id(feat) not in feat_inds:
+                    feat_inds[id(feat)] = len(feats)
+                    feats.append(feat)
+        projected = torch.split(self.projector(torch.cat(feats, dim=0)),
+                                [feat.size(0) for feat in feats], dim=0)
+        s = torch.cat([projected[feat_inds[id(source_feat)]] for source_feat, _, _ in pairs], dim=0)
+        t = torch.cat([projected[feat_inds[id(target_feat)]] for _, target_feat, _ in pairs], dim=0)
+        alpha_weight = 0
+        if any(torch.is_tensor(alpha) or alpha != 0 for _, _, alpha in pairs):
+            alpha_weight = torch.cat([
+                torch.as_tensor(alpha, dtype=s.dtype, device=s.device).expand(source_feat.size(0))
+                for source_feat, _, alpha in pairs]).view(-1, 1, 1)
+        deformed_shapes = self.forward_projected(s, t, mean_shape_half, alpha_weight)
+        deformed_shapes = torch.split(deformed_shapes, [source_feat.size(0) for source_feat, _, _ in pairs], dim=0)
+        return [{"deformed_shape": deformed_shape} for deformed_shape in deformed_shapes]
+
+    def forward_projected(self, s, t, mean_shape_half, alpha_weight=0):
+        """
+        Gate stack, fusion and shape prediction on projector outputs,
+        so callers can project each feature once and pair them freely.
+        Returns B x V x 3 deformed shapes.
+        """
+        s, t = self.gate(s, t)
+        fused_feat = nn.ReLU()(self.fuse_layer(s, t, alpha_weight))
+        delta_flow = self.shape_predictor(fused_feat)
+        return self.symmetrize(delta_flow + mean_shape_half.unsqueeze(dim=0))
+
+    def forward_alpha(self, source_feat, target_feat, mean_shape_half, alphas):
+        """
+        Evaluates the shapes for N fuse weights (alpha) of each pair.
+        The projector and the gate stack run once per pair; fusion and
+        shape prediction run once on the B*N stacked batch.
+        Returns B x N x V x 3 deformed shapes.
+        """
+        alphas = torch.as_tensor(alphas, dtype=source_feat.dtype, device=source_feat.device).view(-1)
+        bs, num_alphas = source_feat.size(0), alphas.size(0)
+        s, t = self.gate(self.projector(source_feat), self.projector(target_feat))
+        s = s.repeat_interleave(num_alphas, dim=0)
+        t = t.repeat_interleave(num_alphas, dim=0)
+        alpha_weight = alphas.repeat(bs).view(-1, 1, 1)
+        fused_feat = nn.ReLU()(self.fuse_layer(s, t, alpha_weight))
+        delta_flow = self.shape_predictor(fused_feat)
+        deformed_shapes = self.symmetrize(delta_flow + mean_shape_half.unsqueeze(dim=0))
+        return deformed_shapes.view(bs, num_alphas, -1, 3)
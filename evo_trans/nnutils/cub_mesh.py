@@ -28,9 +28,9 @@ from . import net_blocks as nb
 #------------- Modules ------------#
 #----------------------------------#
 class ResNetConv(nn.Module):
-    def __init__(self, n_blocks=4):
+    def __init__(self, n_blocks=4, pretrained=True):
         super(ResNetConv, self).__init__()
-        self.resnet = torchvision.models.resnet18(pretrained=True)
+        self.resnet = torchvision.models.resnet18(pretrained=pretrained)
         self.n_blocks = n_blocks
 
     def forward(self, x):
@@ -59,9 +59,9 @@ class Encoder(nn.Module):
     This is sent to 2 fc layers with final output nz_feat.
     """
 
-    def __init__(self, input_shape, n_blocks=4, nz_feat=100, batch_norm=True, z_dim=200):
+    def __init__(self, input_shape, n_blocks=4, nz_feat=100, batch_norm=True, z_dim=200, pretrained=True):
         super(Encoder, self).__init__()
-        self.resnet_conv = ResNetConv(n_blocks=4)
+        self.resnet_conv = ResNetConv(n_blocks=4, pretrained=pretrained)
         self.enc_conv1 = nb.conv2d(batch_norm, 512, 256, stride=2, kernel_size=4)
         nc_input = 256 * (input_shape[0] // 64) * (input_shape[1] // 64)
         self.enc_fc = nb.fc_stack(nc_input, nz_feat, 2)
@@ -82,7 +82,7 @@ class Encoder(nn.Module):
         # logvar= -12.25, -13.65, -14.20, -12.96
         var = logvar.mul(0.5).exp_()# 0.00, 0.00, 0.00, 0.00, 0.00, 0.00
         eps = torch.FloatTensor(var.size()).normal_()
-        eps = eps.cuda()
+        eps = eps.to(var.device)
         return eps.mul(var).add_(mu)#equals eps
 
     def forward(self, img):
@@ -148,6 +148,36 @@ class TexturePredictorUV(nn.Module):
 
 
 
+class UVTextureSampler(object):
+    """
+    Builds per-face textures from a uv image, i.e.
+    grid_sample(uv_image, uv_sampler, align_corners=True) followed by the
+    symmetric texture expansion, in a single sampling call.
+    The sampling grid already lists the mirrored (left) faces, which reuse
+    the last num_sym_faces faces, so no concatenated copy is needed.
+    """
+
+    def __init__(self, uv_sampler, num_sym_faces=0):
+        # uv_sampler: F x T*T x 2
+        num_faces = uv_sampler.size(0)
+        self.T = int(round(math.sqrt(uv_sampler.size(1))))
+        face_index = torch.cat([torch.arange(num_faces), torch.arange(num_faces - num_sym_faces, num_faces)])
+        self.uv_sampler = uv_sampler.detach()[face_index.to(uv_sampler.device)].unsqueeze(0)
+        self.num_faces = face_index.size(0)
+
+    def __call__(self, uv_images):
+        """
+        uv_images: B x C x H x W
+        Returns B x F x T x T x C per-face textures.
+        """
+        bs, nc = uv_images.shape[:2]
+        if self.uv_sampler.device != uv_images.device:
+            self.uv_sampler = self.uv_sampler.to(uv_images.device)
+        uv_sampler = self.uv_sampler.expand(bs, -1, -1, -1)
+        tex = torch.nn.functional.grid_sample(uv_images, uv_sampler, align_corners=True)
+        return tex.view(bs, nc, self.num_faces, self.T, self.T).permute(0, 2, 3, 4, 1)
+
+
 class ShapePredictor(nn.Module):
     """
     Outputs mesh deformations
@@ -343,7 +373,7 @@ class MultiCamPredictor(nn.Module):
         dist = torch.distributions.multinomial.Multinomial(probs=cam[:, :, 7])
         sample = dist.sample()
         sample_inds = torch.nonzero(sample)[:, None, 1]
-        sampled_cam = torch.gather(cam, dim=1, index=sample_inds.unsqueeze(-1).repeat(1, 1, 8)).squeeze()[:, 0:7]
+        sampled_cam = torch.gather(cam, dim=1, index=sample_inds.unsqueeze(-1).repeat(1, 1, 8)).squeeze(1)[:, 0:7]
         #torch.Size([16, 7]) torch.Size([16, 1]) torch.Size([16, 8]) torch.Size([16, 8, 7])
         return sampled_cam, sample_inds, cam[:, :, 7], cam[:, :, 0:7]
 
@@ -361,12 +391,20 @@ class MeshNet(nn.Module):
         self.nz_feat = nz_feat
         self.z_dim = opts.z_dim
         self.batch_size = opts.batch_size
+        self.device = torch.device(opts.device)
 
-        verts, faces = mesh.create_sphere(opts.subdivide)
+        if self.symmetric:
+            topology = mesh.load_symmetric_topology(opts.subdivide, axis=axis,
+                                                    tex_size=opts.tex_size if self.pred_texture else None,
+                                                    cache_dir=opts.topology_cache_dir)
+            verts, faces = topology['verts'], topology['faces']
+            num_indept, num_sym = topology['num_indept'], topology['num_sym']
+            num_indept_faces, num_sym_faces = topology['num_indept_faces'], topology['num_sym_faces']
+        else:
+            verts, faces = mesh.create_sphere(opts.subdivide)
         num_verts = verts.shape[0]
 
         if self.symmetric:
-            verts, faces, num_indept, num_sym, num_indept_faces, num_sym_faces = mesh.make_symmetric(verts, faces, axis=axis)
 
             num_sym_output = num_indept + num_sym
             self.num_output = num_sym_output
@@ -376,13 +414,13 @@ class MeshNet(nn.Module):
             self.num_sym_faces = num_sym_faces
 
             # mean shape is only half.
-            mean_v = nn.Parameter(torch.Tensor(verts[:num_sym_output]).cuda())
+            mean_v = nn.Parameter(torch.Tensor(verts[:num_sym_output]).to(self.device))
             if(temp_path is not None):
-                mean_v = torch.load(osp.join(temp_path, "mean_v.pth"))
+                mean_v = torch.load(osp.join(temp_path, "mean_v.pth"), map_location=self.device)
             self.register_buffer('mean_v', mean_v)
 
             # Needed for symmetrizing..
-            self.flip = torch.ones(1, 3).cuda()
+            self.flip = torch.ones(1, 3).to(self.device)
             self.flip[0, axis] = -1
         else:
             self.mean_v = nn.Parameter(torch.Tensor(verts), requires_grad=False)
@@ -392,9 +430,10 @@ class MeshNet(nn.Module):
         faces_np = faces
         self.verts_np = verts_np
         self.faces_np = faces_np
-        self.faces = torch.LongTensor(faces).cuda()
+        self.faces = torch.LongTensor(faces).to(self.device)
 
-        self.encoder = Encoder(input_shape, n_blocks=4, nz_feat=nz_feat, z_dim=opts.z_dim)
+        self.encoder = Encoder(input_shape, n_blocks=4, nz_feat=nz_feat, z_dim=opts.z_dim,
+                               pretrained=opts.pretrained_resnet)
         self.shape_predictor = ShapePredictor(opts.z_dim, num_verts=self.num_output)
 
         if(self.pred_cam):
@@ -412,9 +451,12 @@ class MeshNet(nn.Module):
             else:
                 num_faces = faces.shape[0]
 
-            uv_sampler = mesh.compute_uvsampler(verts_np, faces_np[:num_faces], tex_size=opts.tex_size)
-            uv_sampler = torch.FloatTensor(uv_sampler).cuda()
-            uv_sampler = uv_sampler.unsqueeze(0).repeat(int(self.opts.batch_size/self.opts.gpu_num), 1, 1, 1, 1)
+            if self.symmetric:
+                uv_sampler = topology['uv_sampler'][:num_faces]
+            else:
+                uv_sampler = mesh.compute_uvsampler(verts_np, faces_np[:num_faces], tex_size=opts.tex_size)
+            # stored once and broadcast over the batch in forward
+            uv_sampler = torch.FloatTensor(uv_sampler).to(self.device).unsqueeze(0)
             self.F = uv_sampler.size(1)
             self.T = uv_sampler.size(2)
 
@@ -435,6 +477,15 @@ class MeshNet(nn.Module):
 
         self.freeze_layers()
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store one uv_sampler copy per sample of the batch
+        # (sliced in a shallow copy, the caller's dict is left untouched)
+        key = prefix + 'uv_sampler'
+        if key in state_dict:
+            state_dict = dict(state_dict)
+            state_dict[key] = state_dict[key][:1]
+        super(MeshNet, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def freeze_layers(self):
         # img_feat related
         for param in self.encoder.resnet_conv.parameters():
@@ -461,7 +512,7 @@ class MeshNet(nn.Module):
             else:
                 cam = self.cam_predictor.forward(img_feat) ## quat (0:4), prop(4:5), scale(5:6), trans(6:8)
                 cam = torch.cat([cam[:,5:6], cam[:, 6:8], cam[:,0:4]],dim=1)# scale(0) trans(1,2) quat(3,4,5,6)
-                sample_inds = torch.zeros(cam[:, None, 0].shape).long().cuda()
+                sample_inds = torch.zeros(cam[:, None, 0].shape).long().to(cam.device)
                 cam_probs = sample_inds.float() + 1
 
         outputs['mean'] = mean
@@ -473,11 +524,8 @@ class MeshNet(nn.Module):
 
 
         if self.pred_texture:
-            if(self.uv_sampler.size(0) != img_feat.size(0)):
-                uv_sampler = self.uv_sampler[0].unsqueeze(0).repeat(img_feat.size(0), 1, 1, 1)
-                texture_pred, uvimage_pred = self.texture_predictor(img_feat, uv_sampler)
-            else:
-                texture_pred, uvimage_pred = self.texture_predictor(img_feat, self.uv_sampler)
+            uv_sampler = self.uv_sampler.expand(img_feat.size(0), -1, -1, -1)
+            texture_pred, uvimage_pred = self.texture_predictor(img_feat, uv_sampler)
             outputs['tex_flow'] = texture_pred
             outputs['uvimage_pred'] = uvimage_pred
         if pred_vs:
@@ -486,6 +534,20 @@ class MeshNet(nn.Module):
 
         return outputs
 
+    def forward_split(self, imgs, pred_vs=False):
+        """
+        Runs a single forward pass over a list of image batches
+        (concatenated along the batch dim) and splits the outputs back.
+        Returns one output dict per input batch.
+        """
+        sizes = [img.size(0) for img in imgs]
+        outputs = self.forward(torch.cat(imgs, dim=0), pred_vs=pred_vs)
+        outputs_split = [{} for _ in imgs]
+        for k, v in outputs.items():
+            for output, chunk in zip(outputs_split, torch.split(v, sizes, dim=0)):
+                output[k] = chunk
+        return outputs_split
+
     def symmetrize(self, V):
         """
         Takes num_indept+num_sym verts and makes it
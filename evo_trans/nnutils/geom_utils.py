@@ -83,6 +83,35 @@ def hamilton_product(qa, qb):
     return torch.stack([q_mult_0, q_mult_1, q_mult_2, q_mult_3], dim=-1)
 
 
+def axis_angle_to_quat(axis, angle):
+    """Quaternions for rotations by angle around a fixed axis.
+
+    Args:
+        axis: 3 unit vector (list or tensor)
+        angle: N angles in radians
+    Returns:
+        quat: N X 4
+    """
+    angle = torch.as_tensor(angle, dtype=torch.float32)
+    axis = torch.as_tensor(axis, dtype=angle.dtype, device=angle.device)
+    half_sin = torch.sin(angle / 2)
+    return torch.stack([torch.cos(angle / 2), axis[0] * half_sin, axis[1] * half_sin, axis[2] * half_sin], dim=-1)
+
+
+def azimuth_elevation_quat(azimuth, elevation):
+    """Quaternions of N viewpoints given as azimuth (around y) and elevation (around x).
+
+    Args:
+        azimuth: N angles in radians
+        elevation: N angles in radians
+    Returns:
+        quat: N X 4, the azimuth rotation is applied first
+    """
+    q_az = axis_angle_to_quat([0, 1, 0], azimuth)
+    q_el = axis_angle_to_quat([1, 0, 0], elevation)
+    return hamilton_product(q_el.unsqueeze(0), q_az.unsqueeze(0)).squeeze(0)
+
+
 def quat_rotate(X, q):
     """Rotate points by quaternions.
 
@@ -34,12 +34,18 @@ import tqdm
 
 import torch
 import torch.nn as nn
-import neural_renderer
 from ..nnutils import geom_utils
 
 class NMR(object):
-    def __init__(self, image_size, anti_aliasing, camera_mode, perspective):
-        renderer = neural_renderer.Renderer(image_size=image_size, anti_aliasing=anti_aliasing, camera_mode=camera_mode, perspective=perspective, background_color=[0,0,0])
+    def __init__(self, image_size, anti_aliasing, camera_mode, perspective, device='cuda'):
+        if torch.device(device).type == 'cpu':
+            # neural_renderer only rasterizes with CUDA kernels
+            from . import torch_rasterizer
+            renderer = torch_rasterizer.Renderer(image_size=image_size, anti_aliasing=anti_aliasing, camera_mode=camera_mode, perspective=perspective, background_color=[0,0,0])
+        else:
+            # imported here so the module (and the networks using it) load without the CUDA extension
+            import neural_renderer
+            renderer = neural_renderer.Renderer(image_size=image_size, anti_aliasing=anti_aliasing, camera_mode=camera_mode, perspective=perspective, background_color=[0,0,0])
         self.renderer = renderer
 
     def forward_mask(self, vertices, faces):
@@ -87,9 +93,9 @@ class Render(nn.Module):
             return imgs
 
 class NeuralRenderer(nn.Module):
-    def __init__(self, img_size = 256):
+    def __init__(self, img_size = 256, device = 'cuda'):
         super(NeuralRenderer, self).__init__()
-        self.renderer = NMR(image_size=img_size, anti_aliasing=True, camera_mode='look_at', perspective=False)
+        self.renderer = NMR(image_size=img_size, anti_aliasing=True, camera_mode='look_at', perspective=False, device=device)
 
         # Set a default camera to be at (0, 0, -2.732)
         self.renderer.renderer.eye = [0, 0, -2.732]
@@ -118,6 +124,27 @@ class NeuralRenderer(nn.Module):
         proj = self.proj_fn(verts, cams)
         return proj[:, :, :2]
 
+    def render_views(self, vertices, faces, cams, textures, view_quats):
+        """
+        Renders each mesh from N extra viewpoints in one batched call.
+        Args:
+            vertices: B X N_v X 3, faces: B X F X 3, cams: B X 7
+            textures: B X F X T X T X T X 3
+            view_quats: N X 4 rotations applied to the mesh before the camera
+        Returns:
+            images: B X N X 3 X H X W
+        """
+        bs, num_views = vertices.size(0), view_quats.size(0)
+        view_quats = view_quats.to(cams.device)
+        quats = geom_utils.hamilton_product(cams[:, None, -4:].expand(bs, num_views, 4),
+                                            view_quats[None].expand(bs, num_views, 4))
+        cams = torch.cat([cams[:, None, :-4].expand(bs, num_views, cams.size(1) - 4), quats], dim=2)
+        images = self.forward(vertices.repeat_interleave(num_views, dim=0),
+                              faces.repeat_interleave(num_views, dim=0),
+                              cams.view(bs * num_views, -1),
+                              textures.repeat_interleave(num_views, dim=0))
+        return images.view(bs, num_views, *images.shape[1:])
+
     def forward(self, vertices, faces, cams=None, textures=None):
         faces = faces.int()
         if cams is None:
@@ -0,0 +1,173 @@
+# Pure torch (cpu) counterpart of neural_renderer.Renderer, used when the CUDA
+# extension cannot run. It follows render_rgb/render_silhouettes of neural_renderer
+# (fill back, per-face lighting, look_at camera, one-sided inside test, perspective
+# correct depth and texture weights, trilinear texel blend, 2x2 anti-aliasing), but
+# rasterizes each face over its pixel bounding box instead of each pixel over all faces.
+# Forward only.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+import torch.nn.functional as F
+
+
+def look_at(vertices, eye, at=(0, 0, 0), up=(0, 1, 0)):
+    eye = torch.as_tensor(eye, dtype=vertices.dtype, device=vertices.device).view(1, 3)
+    at = torch.as_tensor(at, dtype=vertices.dtype, device=vertices.device).view(1, 3)
+    up = torch.as_tensor(up, dtype=vertices.dtype, device=vertices.device).view(1, 3)
+    z_axis = F.normalize(at - eye, eps=1e-5)
+    x_axis = F.normalize(torch.cross(up, z_axis, dim=1), eps=1e-5)
+    y_axis = F.normalize(torch.cross(z_axis, x_axis, dim=1), eps=1e-5)
+    r = torch.cat([x_axis, y_axis, z_axis], dim=0)
+    return torch.matmul(vertices - eye[:, None], r.t())
+
+
+def vertices_to_faces(vertices, faces):
+    # B x N x 3, B x F x 3 -> B x F x 3 x 3
+    bs, nv = vertices.shape[:2]
+    faces = faces.long() + (torch.arange(bs, device=faces.device) * nv).view(-1, 1, 1)
+    return vertices.reshape(bs * nv, 3)[faces]
+
+
+def lighting(faces, textures, intensity_ambient, intensity_directional, color_ambient, color_directional,
+             direction):
+    bs, nf = faces.shape[:2]
+    color_ambient = torch.as_tensor(color_ambient, dtype=faces.dtype, device=faces.device)
+    color_directional = torch.as_tensor(color_directional, dtype=faces.dtype, device=faces.device)
+    direction = torch.as_tensor(direction, dtype=faces.dtype, device=faces.device)
+    light = faces.new_zeros(bs, nf, 3)
+    if intensity_ambient != 0:
+        light = light + intensity_ambient * color_ambient
+    if intensity_directional != 0:
+        normals = F.normalize(torch.cross(faces[:, :, 0] - faces[:, :, 1], faces[:, :, 2] - faces[:, :, 1], dim=2),
+                              dim=2, eps=1e-5)
+        cos = F.relu((normals * direction).sum(dim=2))
+        light = light + intensity_directional * color_directional * cos[..., None]
+    return textures * light[:, :, None, None, None, :]
+
+
+class Renderer(object):
+    """
+    Same settings as neural_renderer.Renderer (orthographic look_at camera only).
+    """
+
+    def __init__(self, image_size=256, anti_aliasing=True, background_color=(0, 0, 0), fill_back=True,
+                 camera_mode='look_at', perspective=False, near=0.1, far=100, rasterizer_eps=1e-3,
+                 max_images=8):
+        assert camera_mode == 'look_at' and not perspective, 'only the orthographic look_at camera is supported'
+        self.image_size = image_size
+        self.anti_aliasing = anti_aliasing
+        self.background_color = background_color
+        self.fill_back = fill_back
+        self.near = near
+        self.far = far
+        self.rasterizer_eps = rasterizer_eps
+        self.eye = [0, 0, -(1. / 0.5773502691896258 + 1)]
+        self.light_intensity_ambient = 0.5
+        self.light_intensity_directional = 0.5
+        self.light_color_ambient = [1, 1, 1]
+        self.light_color_directional = [1, 1, 1]
+        self.light_direction = [0, 1, 0]
+        # images rasterized together, bounds the memory of the face/pixel candidates
+        self.max_images = max_images
+
+    def render_silhouettes(self, vertices, faces):
+        if self.fill_back:
+            faces = torch.cat([faces, faces[:, :, [2, 1, 0]]], dim=1)
+        faces = vertices_to_faces(look_at(vertices, self.eye), faces)
+        return self.rasterize(faces)[1]
+
+    def render_rgb(self, vertices, faces, textures):
+        if self.fill_back:
+            faces = torch.cat([faces, faces[:, :, [2, 1, 0]]], dim=1)
+            textures = torch.cat([textures, textures.permute(0, 1, 4, 3, 2, 5)], dim=1)
+        textures = lighting(vertices_to_faces(vertices, faces), textures,
+                            self.light_intensity_ambient, self.light_intensity_directional,
+                            self.light_color_ambient, self.light_color_directional, self.light_direction)
+        faces = vertices_to_faces(look_at(vertices, self.eye), faces)
+        return self.rasterize(faces, textures)[0]
+
+    def rasterize(self, faces, textures=None):
+        """
+        faces: B x F x 3 x 3 in camera space, textures: B x F x T x T x T x 3.
+        Returns (B x 3 x H x W rgb or None, B x H x W alpha).
+        """
+        rgbs, alphas = [], []
+        with torch.no_grad():
+            for start in range(0, faces.size(0), self.max_images):
+                rgb, alpha = self._rasterize(faces[start:start + self.max_images],
+                                             None if textures is None else textures[start:start + self.max_images])
+                rgbs.append(rgb)
+                alphas.append(alpha)
+        rgb = None if textures is None else torch.cat(rgbs, dim=0)
+        return rgb, torch.cat(alphas, dim=0)
+
+    def _rasterize(self, faces, textures):
+        bs, nf = faces.shape[:2]
+        size = self.image_size * 2 if self.anti_aliasing else self.image_size
+        faces = faces.reshape(bs * nf, 3, 3).float()
+        x, y, z = faces[..., 0], faces[..., 1], faces[..., 2]
+        # faces of the other winding never pass the inside test (they are drawn by fill_back)
+        det = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+        # pixel p covers (2 * p + 1 - size) / size
+        lo = ((torch.stack([x.min(1)[0], y.min(1)[0]], 1) * size + size - 1) / 2).ceil().clamp(0, size)
+        hi = ((torch.stack([x.max(1)[0], y.max(1)[0]], 1) * size + size - 1) / 2).floor().clamp(-1, size - 1)
+        extent = (hi - lo + 1).clamp(min=0).long()
+        count = extent[:, 0] * extent[:, 1]
+        count[det <= 0] = 0
+        face = torch.arange(bs * nf, device=faces.device).repeat_interleave(count)
+        # position of every candidate pixel inside the bounding box of its face
+        local = torch.arange(face.size(0), device=faces.device) - (count.cumsum(0) - count)[face]
+        width = extent[face, 0]
+        px = lo[face, 0].long() + local % width
+        py = lo[face, 1].long() + local // width
+        xp = (2 * px.float() + 1 - size) / size
+        yp = (2 * py.float() + 1 - size) / size
+        fx, fy, fz = x[face], y[face], z[face]
+        outside = ((yp - fy[:, 0]) * (fx[:, 1] - fx[:, 0]) < (xp - fx[:, 0]) * (fy[:, 1] - fy[:, 0])) | \
+                  ((yp - fy[:, 1]) * (fx[:, 2] - fx[:, 1]) < (xp - fx[:, 1]) * (fy[:, 2] - fy[:, 1])) | \
+                  ((yp - fy[:, 2]) * (fx[:, 0] - fx[:, 2]) < (xp - fx[:, 2]) * (fy[:, 0] - fy[:, 2]))
+        w1 = ((xp - fx[:, 0]) * (fy[:, 2] - fy[:, 0]) - (fx[:, 2] - fx[:, 0]) * (yp - fy[:, 0])) / det[face]
+        w2 = ((fx[:, 1] - fx[:, 0]) * (yp - fy[:, 0]) - (xp - fx[:, 0]) * (fy[:, 1] - fy[:, 0])) / det[face]
+        w = torch.stack([1 - w1 - w2, w1, w2], dim=1).clamp(0, 1)
+        w = w / w.sum(dim=1, keepdim=True)
+        zp = 1. / (w / fz).sum(dim=1)
+        keep = ~outside & (zp > self.near) & (zp < self.far)
+        face, px, py, w, zp = face[keep], px[keep], py[keep], w[keep], zp[keep]
+        # z-buffer: the nearest face of every pixel
+        pixel = (face // nf) * size * size + py * size + px
+        order = torch.argsort(pixel.double() * (self.far + 1) + zp.double())
+        pixel, face, w, zp = pixel[order], face[order], w[order], zp[order]
+        first = torch.ones_like(pixel, dtype=torch.bool)
+        first[1:] = pixel[1:] != pixel[:-1]
+        pixel, face, w, zp = pixel[first], face[first], w[first], zp[first]
+
+        alpha = faces.new_zeros(bs * size * size)
+        alpha[pixel] = 1
+        alpha = alpha.view(bs, 1, size, size)
+        rgb = None
+        if textures is not None:
+            ts = textures.size(2)
+            texels = textures.reshape(bs * nf, ts ** 3, 3).float()
+            # perspective corrected texture coordinates, then a trilinear blend of the 8 texels
+            tif = (w * (ts - 1) * zp[:, None] / z[face]).clamp(min=0, max=ts - 1 - self.rasterizer_eps)
+            tii = tif.long()
+            frac = tif - tii
+            color = faces.new_zeros(pixel.size(0), 3)
+            for corner in range(8):
+                bits = torch.tensor([(corner >> k) & 1 for k in range(3)], device=faces.device)
+                weight = torch.where(bits.bool(), frac, 1 - frac).prod(dim=1)
+                index = ((tii + bits) * torch.tensor([ts * ts, ts, 1], device=faces.device)).sum(dim=1)
+                color += weight[:, None] * texels[face, index]
+            rgb = torch.as_tensor(self.background_color, dtype=color.dtype, device=color.device)
+            rgb = rgb.repeat(bs * size * size, 1)
+            rgb[pixel] = color
+            rgb = rgb.view(bs, size, size, 3).permute(0, 3, 1, 2)
+        if self.anti_aliasing:
+            alpha = F.avg_pool2d(alpha, kernel_size=2)
+            rgb = None if rgb is None else F.avg_pool2d(rgb, kernel_size=2)
+        # image rows run from the top (y = 1) down
+        alpha = alpha.flip(2)[:, 0]
+        rgb = None if rgb is None else rgb.flip(2)
+        return rgb, alpha
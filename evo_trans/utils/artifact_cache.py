@@ -0,0 +1,73 @@
+# Content-addressed store of per-image MeshNet outputs.
+# Artifacts are keyed by a hash of the preprocessed image and live under a directory
+# named after the checkpoint hash, one float16 tensor bundle per image, with an
+# in-memory LRU in front of the disk.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+
+from . import bundle
+
+
+def image_hash(img):
+    img = np.ascontiguousarray(img)
+    return hashlib.md5(str(img.shape).encode('utf-8') + img.tobytes()).hexdigest()
+
+
+def checkpoint_hash(modules, extra=''):
+    md5 = hashlib.md5(extra.encode('utf-8'))
+    for module in modules:
+        for name, value in module.state_dict().items():
+            md5.update(name.encode('utf-8'))
+            md5.update(value.detach().cpu().numpy().tobytes())
+    return md5.hexdigest()
+
+
+class ArtifactStore(object):
+    """
+    Outputs are stored as they were first computed. The camera and the
+    VAE noise are sampled, so an image keeps its first sample from then on.
+    """
+
+    def __init__(self, root, checkpoint_key, max_items=1024):
+        self.root = osp.join(root, checkpoint_key[:16])
+        self.max_items = max_items
+        self.items = collections.OrderedDict()
+        if not osp.exists(self.root):
+            os.makedirs(self.root)
+
+    def path(self, key):
+        return osp.join(self.root, key[:2], key + '.bundle')
+
+    def get(self, key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+        path = self.path(key)
+        if not osp.exists(path):
+            return None
+        artifacts = bundle.load_bundle(path)
+        self._remember(key, artifacts)
+        return artifacts
+
+    def put(self, key, artifacts):
+        artifacts = collections.OrderedDict(
+            (name, value.detach().to('cpu', torch.float16)) for name, value in artifacts.items())
+        path = self.path(key)
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        bundle.save_bundle(path, artifacts)
+        self._remember(key, artifacts)
+        return artifacts
+
+    def _remember(self, key, artifacts):
+        self.items[key] = artifacts
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
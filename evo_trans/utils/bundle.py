@@ -0,0 +1,99 @@
+# Single-file tensor bundle.
+# Layout: 8-byte magic, 8-byte header size, JSON header {name: [dtype, shape, offset]},
+# then the raw tensor data, every tensor aligned to ALIGN bytes.
+# Loading memory-maps the file copy-on-write, so tensors are zero-copy views of the
+# page cache and forked workers share the pages until they write to them.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+
+MAGIC = b'EVOBNDL1'
+ALIGN = 64
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def save_bundle(path, tensors):
+    """
+    Writes a dict of name -> tensor (or numpy array) to path.
+    """
+    arrays = collections.OrderedDict()
+    for name, tensor in tensors.items():
+        if torch.is_tensor(tensor):
+            tensor = tensor.detach().cpu().numpy()
+        # not np.ascontiguousarray, which turns 0-d arrays (e.g. num_batches_tracked) into 1-d
+        arrays[name] = np.require(tensor, requirements='C')
+
+    header = collections.OrderedDict()
+    offset = 0
+    for name, array in arrays.items():
+        header[name] = [array.dtype.str, list(array.shape), offset]
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header[name][2])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_bundle(path):
+    """
+    Maps a bundle written by save_bundle.
+    Returns an ordered dict of name -> CPU tensor backed by the mapped file.
+    """
+    with open(path, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, '%s is not a tensor bundle' % path
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'),
+                            object_pairs_hook=collections.OrderedDict)
+    data_start = _align(len(MAGIC) + 8 + header_size)
+    buf = np.memmap(path, dtype=np.uint8, mode='c')
+
+    tensors = collections.OrderedDict()
+    for name, (dtype, shape, offset) in header.items():
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        start = data_start + offset
+        array = buf[start:start + nbytes].view(dtype).reshape(shape)
+        tensors[name] = torch.from_numpy(array)
+    return tensors
+
+
+def bind_module(module, tensors, prefix='', ignore=()):
+    """
+    Points the parameters and buffers of module at tensors[prefix + name].
+    CPU tensors of matching dtype and shape are used in place (zero-copy),
+    everything else is copied.
+    """
+    state = list(module.named_parameters()) + list(module.named_buffers())
+    missing = [name for name, _ in state if name not in ignore and prefix + name not in tensors]
+    if missing:
+        raise KeyError('Missing keys in bundle: %s' % ', '.join(prefix + name for name in missing))
+    for name, tensor in state:
+        if name in ignore:
+            continue
+        src = tensors[prefix + name]
+        if tensor.device.type == 'cpu' and tensor.dtype == src.dtype and tensor.shape == src.shape:
+            tensor.data = src
+        else:
+            with torch.no_grad():
+                # reshape: older bundles stored 0-d tensors as [1]
+                tensor.copy_(src.reshape(tensor.shape))
@@ -0,0 +1,77 @@
+# Builds the visualization panels on the model device.
+# Text is rasterized once per (string, scale, thickness) into an alpha tile with cv2.putText;
+# all the tiles of an image are then alpha-blended into it with a single index_put_.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import cv2
+import numpy as np
+import torch
+import torchvision.utils as vutils
+
+
+class Compositor(object):
+
+    def __init__(self, device, padding=2, font=cv2.FONT_HERSHEY_SIMPLEX):
+        self.device = torch.device(device)
+        self.padding = padding
+        self.font = font
+        self.glyphs = {}
+
+    def glyph(self, text, scale=1.0, thickness=2):
+        """
+        Returns the h x w alpha tile of text and the offset of the text origin
+        (the bottom left point given to cv2.putText) inside the tile.
+        """
+        key = (text, scale, thickness)
+        if key not in self.glyphs:
+            (w, h), baseline = cv2.getTextSize(text, self.font, scale, thickness)
+            tile = np.zeros((h + baseline + 2 * thickness, w + 2 * thickness), dtype=np.uint8)
+            origin = (thickness, h + thickness)
+            cv2.putText(tile, text, origin, self.font, scale, 255, thickness, cv2.LINE_AA)
+            alpha = torch.from_numpy(tile).to(self.device).float().div_(255)
+            self.glyphs[key] = alpha, origin
+        return self.glyphs[key]
+
+    def grid(self, panels, nrow=1):
+        return vutils.make_grid(panels, nrow=nrow, padding=self.padding)
+
+    def overlay(self, img, texts):
+        """
+        img: 3 x H x W in [0, 1], RGB. texts: (text, (x, y), scale, rgb color) tuples,
+        (x, y) being the cv2.putText origin. Returns img with all texts blended in.
+        """
+        if not texts:
+            return img
+        tiles = [self.glyph(text, scale) for text, _, scale, _ in texts]
+        th = max(alpha.size(0) for alpha, _ in tiles)
+        tw = max(alpha.size(1) for alpha, _ in tiles)
+        alphas = torch.zeros(len(tiles), th, tw, device=img.device)
+        tops, lefts = [], []
+        for i, ((alpha, (ox, oy)), (_, (x, y), _, _)) in enumerate(zip(tiles, texts)):
+            alphas[i, :alpha.size(0), :alpha.size(1)] = alpha
+            tops.append(y - oy)
+            lefts.append(x - ox)
+        colors = torch.tensor([color for _, _, _, color in texts], dtype=img.dtype, device=img.device) / 255
+        ys = torch.tensor(tops, device=img.device).view(-1, 1, 1) + torch.arange(th, device=img.device).view(1, -1, 1)
+        xs = torch.tensor(lefts, device=img.device).view(-1, 1, 1) + torch.arange(tw, device=img.device).view(1, 1, -1)
+        ys, xs = ys.expand_as(alphas), xs.expand_as(alphas)
+        H, W = img.shape[1:]
+        inside = (ys >= 0) & (ys < H) & (xs >= 0) & (xs < W) & (alphas > 0)
+        ys, xs = ys[inside], xs[inside]
+        a = alphas[inside]
+        c = colors.view(-1, 1, 1, 3).expand(-1, th, tw, -1)[inside]
+        # blend canvas: total coverage and premultiplied color of every pixel
+        coverage = torch.zeros(H, W, device=img.device).index_put_((ys, xs), a, accumulate=True).clamp_(max=1)
+        color = torch.zeros(3, H, W, device=img.device)
+        channels = torch.arange(3, device=img.device).view(-1, 1)
+        color.index_put_((channels, ys.view(1, -1), xs.view(1, -1)), (a.view(-1, 1) * c).t(), accumulate=True)
+        return img * (1 - coverage) + color.clamp_(max=1)
+
+    def to_bgr_uint8(self, img):
+        """
+        3 x H x W RGB in [0, 1] to an H x W x 3 BGR uint8 array for cv2.
+        """
+        img = img.flip(0).mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+        return img.permute(1, 2, 0).contiguous().cpu().numpy()
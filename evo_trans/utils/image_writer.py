@@ -0,0 +1,90 @@
+# Background image writer.
+# Finished uint8 images (already composited and labelled on the device) go through a
+# bounded queue to a pool of threads that do the color conversion and the
+# encoding/writing, so inference only waits when the queue is full. cv2 releases the
+# GIL while encoding.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import queue
+import threading
+
+import cv2
+
+
+def encode_params(ext, quality=95, png_compression=3):
+    ext = ext.lower()
+    if ext in ('jpg', 'jpeg'):
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if ext == 'webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    if ext == 'png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    raise ValueError('Unsupported image format: %s' % ext)
+
+
+class AsyncImageWriter(object):
+
+    def __init__(self, ext='jpg', quality=95, png_compression=3, num_threads=2, max_queue=8):
+        self.ext = ext
+        self.params = encode_params(ext, quality, png_compression)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.error_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, path, img, is_bgr=False):
+        """
+        Writes an H x W x 3 uint8 RGB (or BGR) image right away.
+        Returns the written BGR image.
+        """
+        if not is_bgr:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        if not cv2.imwrite('%s.%s' % (path, self.ext), img, self.params):
+            raise IOError('Could not write %s.%s' % (path, self.ext))
+        return img
+
+    def submit(self, path, img, is_bgr=False):
+        """
+        Queues write(path, img, is_bgr); blocks while the queue is full.
+        path has no extension. img must not be modified afterwards.
+        """
+        self.submit_call(self.write, path, img, is_bgr)
+
+    def submit_call(self, fn, *args):
+        """
+        Queues any other output job, e.g. a mesh export, on the same threads.
+        """
+        self._check()
+        self.queue.put((fn, args))
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self._check()
+
+    def _check(self):
+        with self.error_lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception as e:
+                # keep the first failure, later ones are often its consequences
+                with self.error_lock:
+                    if self.error is None:
+                        self.error = e
@@ -29,6 +29,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import numpy as np
 import meshzoo
 import torch
@@ -41,6 +42,42 @@ def create_sphere(n_subdivide=3):
     return verts, faces
 
 
+def load_symmetric_topology(n_subdivide=3, axis=0, tex_size=None, cache_dir=None):
+    """
+    Returns the symmetric icosphere of make_symmetric as a dict with
+    verts, faces, num_indept, num_sym, num_indept_faces, num_sym_faces
+    and, if tex_size is given, the F x T x T x 2 uv_sampler of all faces.
+    The topology is deterministic, so it is stored in cache_dir as an
+    .npz keyed by (n_subdivide, axis, tex_size, meshzoo version) and read
+    back from there on later calls.
+    """
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, 'sym_sphere_s%d_a%d_t%s_meshzoo%s.npz' % (
+            n_subdivide, axis, tex_size, getattr(meshzoo, '__version__', 'unknown')))
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as data:
+                return {k: (data[k] if data[k].ndim else data[k].item()) for k in data.files}
+
+    verts, faces = create_sphere(n_subdivide)
+    verts, faces, num_indept, num_sym, num_indept_faces, num_sym_faces = make_symmetric(verts, faces, axis=axis)
+    topology = {'verts': verts, 'faces': faces,
+                'num_indept': num_indept, 'num_sym': num_sym,
+                'num_indept_faces': num_indept_faces, 'num_sym_faces': num_sym_faces}
+    if tex_size is not None:
+        topology['uv_sampler'] = compute_uvsampler(verts, faces, tex_size=tex_size)
+
+    if cache_file is not None:
+        # write to a temp file first so concurrent workers never read a partial cache
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **topology)
+        os.replace(tmp_file, cache_file)
+    return topology
+
+
 def make_symmetric(verts, faces, axis=0):
     """
     Assumes that the input mesh {V,F} is perfectly symmetric
@@ -65,32 +102,18 @@ def make_symmetric(verts, faces, axis=0):
     assert(len(left_inds) == len(right_inds))
 
     # For each right verts, find the corresponding left verts.
-    if(axis == 0):
-        prop_left_inds = np.hstack([np.where(np.all(verts == np.array([-1, 1, 1]) * verts[ri], 1))[0] for ri in right_inds])
-    elif(axis == 1):
-        prop_left_inds = np.hstack([np.where(np.all(verts == np.array([1, -1, 1]) * verts[ri], 1))[0] for ri in right_inds])
-    else:
-        prop_left_inds = np.hstack([np.where(np.all(verts == np.array([1, 1, -1]) * verts[ri], 1))[0] for ri in right_inds])
+    flip = np.ones(3)
+    flip[axis] = -1
+    prop_left_inds = _match_rows(verts[right_inds] * flip, verts)
+    assert(np.all(prop_left_inds >= 0))
     assert(prop_left_inds.shape[0] == num_sym)
 
     # Make sure right/left order are symmetric.
-    for ind, (ri, li) in enumerate(zip(right_inds, prop_left_inds)):
-        if(axis == 0):
-            if np.any(verts[ri] != np.array([-1, 1, 1]) * verts[li]):
-                print('bad! %d' % ind)
-                import ipdb; ipdb.set_trace()
-        elif(axis == 1):
-            if np.any(verts[ri] != np.array([1, -1, 1]) * verts[li]):
-                print('bad! %d' % ind)
-                import ipdb; ipdb.set_trace()
-        else:
-            if np.any(verts[ri] != np.array([1, 1, -1]) * verts[li]):
-                print('bad! %d' % ind)
-                import ipdb; ipdb.set_trace()
+    assert(np.all(verts[right_inds] == flip * verts[prop_left_inds]))
 
     new_order = np.hstack([center_inds, right_inds, prop_left_inds])
     # verts i is now vert j
-    ind_perm = np.hstack([np.where(new_order==i)[0] for i in range(verts.shape[0])])
+    ind_perm = np.argsort(new_order)
 
     new_verts = verts[new_order, :]
     new_faces0 = ind_perm[faces]
@@ -99,6 +122,25 @@ def make_symmetric(verts, faces, axis=0):
 
     return new_verts, new_faces, num_indept, num_sym, num_indept_faces, num_sym_faces
 
+
+def _match_rows(queries, rows):
+    """
+    For each row of queries, returns the index of the equal row in rows
+    (-1 if there is none), by sorting instead of comparing all pairs.
+    """
+    rows = np.ascontiguousarray(rows + 0.)  # + 0. turns -0. into 0. so equal rows share bytes
+    queries = np.ascontiguousarray(queries + 0.)
+    row_type = np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))
+    rows_key = rows.view(row_type).ravel()
+    queries_key = queries.astype(rows.dtype).view(row_type).ravel()
+    order = np.argsort(rows_key)
+    pos = np.searchsorted(rows_key[order], queries_key)
+    pos = np.minimum(pos, len(order) - 1)
+    match = order[pos]
+    match[rows_key[match] != queries_key] = -1
+    return match
+
+
 def make_faces_symmetric(verts, faces, num_indept_verts, num_sym_verts, axis=0):
     """
     This reorders the faces, such that it has this order:
@@ -117,78 +159,40 @@ def make_faces_symmetric(verts, faces, num_indept_verts, num_sym_verts, axis=0):
     Also, the symmetric face pairs are reordered so that the vertex order is the same.
     i.e. verts[f_id] and verts[f_id_sym] is in the same vertex order, except the x coord are flipped
     """
-    DRAW = False
-    indept_faces = []
-    right_faces = []
-    left_faces = []
-
-    indept_verts = verts[:num_indept_verts]
-    symmetric_verts = verts[num_indept_verts:]
     # These are symmetric pairs
     right_ids = np.arange(num_indept_verts, num_indept_verts+num_sym_verts)
     left_ids = np.arange(num_indept_verts+num_sym_verts, num_indept_verts+2*num_sym_verts)
-    # Make this for easy lookup
-    # Saves for each vert_id, the symmetric vert_ids
-    v_dict = {}
-    for r_id, l_id in zip(right_ids, left_ids):
-        v_dict[r_id] = l_id
-        v_dict[l_id] = r_id
-    # Return itself for indepentnet.
-    for ind in range(num_indept_verts):
-        v_dict[ind] = ind
-
-    # Saves faces that contain this verts
-    verts2faces = [np.where((faces == v_id).any(axis=1))[0] for v_id in range(verts.shape[0])]
-    done_face = np.zeros(faces.shape[0])
-    # Make faces symmetric:
-    for f_id in range(faces.shape[0]):
-        if done_face[f_id]:
-            continue
-        v_ids = sorted(faces[f_id])
-        # This is triangles x [x,y,z]
-        vs = verts[v_ids]
-        # Find the corresponding vs?
-        v_sym_ids = sorted([v_dict[v_id] for v_id in v_ids])
-
-        # Check if it's independent
-        if sorted(v_sym_ids) == sorted(v_ids):
-            # Independent!!
-            indept_faces.append(faces[f_id])
-            # indept_faces.append(f_id)
-            done_face[f_id] = 1
-        else:
-            # Find the face with these verts. (so we can mark it done)
-            possible_faces = np.hstack([verts2faces[v_id] for v_id in v_sym_ids])
-            possible_fids, counts = np.unique(possible_faces, return_counts=True)
-            # The face id is the one that appears 3 times in this list.
-            sym_fid = possible_fids[counts == 3][0]
-            assert(sorted(v_sym_ids) == sorted(faces[sym_fid]))
-            # Make sure that the order of these vertices are the same.
-            # Go in the order of face: f_id
-            face_here = faces[f_id]
-            sym_face_here = [v_dict[v_id] for v_id in face_here]
-            # Above is the same tri as faces[sym_fid], but vertices are in the order of faces[f_id]
-            # Which one is right x > 0?
-            # Only use unique verts in these faces to compute.
-            unique_vids = np.array(v_ids) != np.array(v_sym_ids)
-            #if np.all(verts[face_here][unique_vids, 0] < verts[sym_face_here][unique_vids, 0]):
-            if np.all(verts[face_here][unique_vids, axis] < verts[sym_face_here][unique_vids, axis]):
-                # f_id is left
-                left_faces.append(face_here)
-                right_faces.append(sym_face_here)
-            else:
-                left_faces.append(sym_face_here)
-                right_faces.append(face_here)
-            done_face[f_id] = 1
-            done_face[sym_fid] = 1
-            # Draw
-            # tri_sym = Mesh(verts[v_sym_ids], [[0, 1, 2]], vc='red')
-            # mv.set_dynamic_meshes([mesh, tri, tri_sym])
+    # For each vert_id, the symmetric vert_id (itself for independent verts)
+    v_sym = np.arange(verts.shape[0])
+    v_sym[right_ids] = left_ids
+    v_sym[left_ids] = right_ids
+
+    # Same triangle as faces, but vertices in the order of each face
+    sym_faces = v_sym[faces]
+    v_ids = np.sort(faces, axis=1)
+    v_sym_ids = np.sort(sym_faces, axis=1)
+
+    # Independent faces map onto themselves.
+    indept = np.all(v_ids == v_sym_ids, axis=1)
+    # Find the face with the symmetric verts.
+    sym_fids = _match_rows(v_sym_ids, v_ids)
+    assert(np.all(sym_fids[~indept] >= 0))
+    # Each symmetric pair is handled once, at the face that comes first.
+    first = ~indept & (np.arange(faces.shape[0]) < sym_fids)
+
+    face_here = faces[first]
+    sym_face_here = sym_faces[first]
+    # Which one is right x > 0?
+    # Only use unique verts in these faces to compute.
+    unique_vids = v_ids[first] != v_sym_ids[first]
+    is_left = np.all((verts[face_here, axis] < verts[sym_face_here, axis]) | ~unique_vids, axis=1)
+    left_faces = np.where(is_left[:, None], face_here, sym_face_here)
+    right_faces = np.where(is_left[:, None], sym_face_here, face_here)
+    indept_faces = faces[indept]
 
     assert(len(left_faces) + len(right_faces) + len(indept_faces) == faces.shape[0])
     # Now concatenate them,,
     new_faces = np.vstack([indept_faces, right_faces, left_faces])
-    # Now sort each row of new_faces to make sure that bary centric coord will be same.
     num_indept_faces = len(indept_faces)
     num_sym_faces = len(right_faces)
 
@@ -215,8 +219,8 @@ def compute_uvsampler(verts, faces, tex_size=2):
     F x T x T points.
     Returns F x T x T x 2
     """
-    alpha = np.arange(tex_size, dtype=np.float) / (tex_size-1)
-    beta = np.arange(tex_size, dtype=np.float) / (tex_size-1)
+    alpha = np.arange(tex_size, dtype=np.float64) / (tex_size-1)
+    beta = np.arange(tex_size, dtype=np.float64) / (tex_size-1)
     import itertools
     # Barycentric coordinate values
     coords = np.stack([p for p in itertools.product(*[alpha, beta])])
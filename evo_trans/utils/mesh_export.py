@@ -0,0 +1,161 @@
+# Textured mesh export (binary PLY or glTF .glb).
+# All meshes share the symmetric icosphere topology and its spherical UV map, so the
+# face/UV blocks are built once and only the vertex positions and the uv image change
+# per mesh. Textures are the uv images themselves, not the per-face T x T x T colors.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import struct
+
+import cv2
+import numpy as np
+
+from . import mesh
+
+
+def corner_uvs(verts, faces, num_sym_faces=0):
+    """
+    UV coordinates ([-1, 1], as in uv_sampler) of every face corner of the sphere.
+    The mirrored (last num_sym_faces) faces reuse the UVs of the faces they mirror,
+    like the symmetric texture. Faces across the u seam get u > 1 on their negative
+    side (the texture repeats along u), and pole corners take the mean u of the
+    other two corners.
+    Returns F x 3 x 2.
+    """
+    num_faces = faces.shape[0]
+    face_index = np.arange(num_faces)
+    face_index[num_faces - num_sym_faces:] -= num_sym_faces
+    corners = verts[faces[face_index]]
+    uv = mesh.get_spherical_coords(corners.reshape(-1, 3)).reshape(-1, 3, 2)
+    pole = np.linalg.norm(corners[..., :2], axis=2) < 1e-6
+    u = np.where(pole, np.nan, uv[..., 0])
+    seam = np.nanmax(u, axis=1) - np.nanmin(u, axis=1) > 1
+    u = np.where(seam[:, None] & (u < 0), u + 2, u)
+    uv[..., 0] = np.where(pole, np.nanmean(u, axis=1, keepdims=True), u)
+    return uv
+
+
+class MeshExporter(object):
+
+    def __init__(self, verts, faces, num_sym_faces=0, fmt='glb', image_format='png'):
+        """
+        verts, faces: the sphere of the mesh topology (uv map and faces).
+        """
+        assert fmt in ('glb', 'ply')
+        self.fmt = fmt
+        self.image_format = image_format
+        self.mime_type = 'image/png' if image_format == 'png' else 'image/jpeg'
+        self.faces = np.asarray(faces, dtype=np.int64)
+        self.uv = corner_uvs(np.asarray(verts, dtype=np.float64), self.faces, num_sym_faces)
+        # glTF has per-vertex uvs only: split vertices where their corners have different uvs
+        keys = np.concatenate([self.faces.reshape(-1, 1).astype(np.float64), self.uv.reshape(-1, 2)], axis=1)
+        keys, wedge_faces = np.unique(keys, axis=0, return_inverse=True)
+        self.wedge_verts = keys[:, 0].astype(np.int64)
+        self.wedge_uv = keys[:, 1:]
+        self.wedge_faces = wedge_faces.reshape(-1, 3).astype(np.uint32)
+        self.blocks = {}
+
+    def texcoords(self, uv, size):
+        # grid_sample(align_corners=True) puts -1/1 at the centers of the border pixels
+        H, W = size
+        st = np.empty_like(uv)
+        st[..., 0] = ((uv[..., 0] + 1) / 2 * (W - 1) + 0.5) / W
+        st[..., 1] = ((uv[..., 1] + 1) / 2 * (H - 1) + 0.5) / H
+        return st.astype(np.float32)
+
+    def shared_blocks(self, size):
+        # the parts of a file that only depend on the texture size
+        if size not in self.blocks:
+            if self.fmt == 'ply':
+                face_dtype = np.dtype([('n', 'u1'), ('vertex_indices', '<i4', 3), ('m', 'u1'), ('texcoord', '<f4', 6)])
+                records = np.empty(self.faces.shape[0], dtype=face_dtype)
+                records['n'] = 3
+                records['vertex_indices'] = self.faces
+                records['m'] = 6
+                # PLY texture coordinates start at the bottom left
+                st = self.texcoords(self.uv, size)
+                st[..., 1] = 1 - st[..., 1]
+                records['texcoord'] = st.reshape(-1, 6)
+                self.blocks[size] = records.tobytes()
+            else:
+                self.blocks[size] = (self.wedge_faces.tobytes(), self.texcoords(self.wedge_uv, size).tobytes())
+        return self.blocks[size]
+
+    def export(self, path, verts, texture):
+        """
+        Writes one mesh to path (without extension).
+        verts: V x 3 float, texture: H x W x 3 uint8 RGB uv image.
+        """
+        ok, image = cv2.imencode('.' + self.image_format, cv2.cvtColor(texture, cv2.COLOR_RGB2BGR))
+        assert ok, 'Could not encode the texture of %s' % path
+        verts = np.asarray(verts, dtype=np.float32)
+        if self.fmt == 'ply':
+            self.write_ply(path, verts, image.tobytes(), texture.shape[:2])
+        else:
+            self.write_glb(path, verts, image.tobytes(), texture.shape[:2])
+
+    def write_ply(self, path, verts, image, size):
+        texture_file = '%s.%s' % (path, self.image_format)
+        with open(texture_file, 'wb') as f:
+            f.write(image)
+        header = '\n'.join([
+            'ply',
+            'format binary_little_endian 1.0',
+            'comment TextureFile %s' % texture_file.replace('\\', '/').split('/')[-1],
+            'element vertex %d' % verts.shape[0],
+            'property float x',
+            'property float y',
+            'property float z',
+            'element face %d' % self.faces.shape[0],
+            'property list uchar int vertex_indices',
+            'property list uchar float texcoord',
+            'end_header\n'])
+        with open(path + '.ply', 'wb') as f:
+            f.write(header.encode('ascii'))
+            f.write(verts.tobytes())
+            f.write(self.shared_blocks(size))
+
+    def write_glb(self, path, verts, image, size):
+        indices, texcoords = self.shared_blocks(size)
+        positions = verts[self.wedge_verts]
+        chunks = [indices, texcoords, positions.tobytes(), image]
+        views, offset = [], 0
+        for chunk in chunks:
+            views.append({'buffer': 0, 'byteOffset': offset, 'byteLength': len(chunk)})
+            offset += (len(chunk) + 3) // 4 * 4
+        views[0]['target'] = 34963
+        views[1]['target'] = views[2]['target'] = 34962
+        gltf = {
+            'asset': {'version': '2.0'},
+            'scene': 0,
+            'scenes': [{'nodes': [0]}],
+            'nodes': [{'mesh': 0}],
+            'meshes': [{'primitives': [{'attributes': {'POSITION': 2, 'TEXCOORD_0': 1}, 'indices': 0, 'material': 0}]}],
+            # the renderer draws back faces too
+            'materials': [{'pbrMetallicRoughness': {'baseColorTexture': {'index': 0},
+                                                    'metallicFactor': 0.0, 'roughnessFactor': 1.0},
+                           'doubleSided': True}],
+            'textures': [{'source': 0, 'sampler': 0}],
+            'samplers': [{'magFilter': 9729, 'minFilter': 9729, 'wrapS': 10497, 'wrapT': 33071}],
+            'images': [{'bufferView': 3, 'mimeType': self.mime_type}],
+            'buffers': [{'byteLength': offset}],
+            'bufferViews': views,
+            'accessors': [
+                {'bufferView': 0, 'componentType': 5125, 'count': self.wedge_faces.size, 'type': 'SCALAR'},
+                {'bufferView': 1, 'componentType': 5126, 'count': self.wedge_uv.shape[0], 'type': 'VEC2'},
+                {'bufferView': 2, 'componentType': 5126, 'count': positions.shape[0], 'type': 'VEC3',
+                 'min': positions.min(axis=0).tolist(), 'max': positions.max(axis=0).tolist()},
+            ],
+        }
+        json_chunk = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+        json_chunk += b' ' * (-len(json_chunk) % 4)
+        with open(path + '.glb', 'wb') as f:
+            f.write(struct.pack('<III', 0x46546C67, 2, 12 + 8 + len(json_chunk) + 8 + offset))
+            f.write(struct.pack('<II', len(json_chunk), 0x4E4F534A))
+            f.write(json_chunk)
+            f.write(struct.pack('<II', offset, 0x004E4942))
+            for chunk in chunks:
+                f.write(chunk)
+                f.write(b'\0' * (-len(chunk) % 4))